@@ -3,17 +3,8 @@ import sys
 import argparse
 import os
 import os.path
-from operator import itemgetter
-import shutil
 import logging
-import codecs
-import copy
-import json
-import anki
-import util
-from kanjidamage import KanjiDamage
-from tangorin import Tangorin as tg
-from anki.exporting import AnkiPackageExporter
+import profiling
 
 
 # constants
@@ -22,238 +13,210 @@ DEFAULT_OUT_FILE = 'KanjiDamageWords.apkg'
 DEFAULT_ANKI_DIR = os.path.join('Documents', 'Anki')
 DEFAULT_ANKI_PROFILE = 'Teste'
 DEFAULT_ANKI_COL = 'collection.anki2'
-TG_FILE = 'tangorin.json'
-KDW_DECK = 'KanjiDamage Words'
-KDW_MODEL = 'KanjiDamageWords'
-
-
-# parse command line arguments
-opt_parser = argparse.ArgumentParser(description='Generates Anki collections based on KanjiDamage deck.')
-opt_group_path = opt_parser.add_mutually_exclusive_group();
-opt_group_path.add_argument('-f', '--file', help='path to collection file (overwrites -p)', metavar="COLLECTION")
-opt_group_path.add_argument('-p', '--profile', help='the Anki profile to be used (will use default Anki path)')
-opt_parser.add_argument('-o', '--output', default=DEFAULT_OUT_FILE, help='KanjiDamage Words output file', metavar="PATH")
-opt_group_verb = opt_parser.add_mutually_exclusive_group();
-opt_group_verb.add_argument('-v', '--verbose', action='store_true', help='show detailed messages')
-opt_group_verb.add_argument('-q', '--quiet', action='store_true', help='show no message')
-opt_parser.add_argument('-r', '--reset-kd', action='store_true', help='reimports Kanji Damage deck into the collection')
-opt_parser.add_argument('-k', '--kd-file', default=DEFAULT_KD_FILE, help='Kanji Damage deck file', metavar="APKG")
-opt_parser.add_argument('-u', '--update-kd', action='store_true', help='updates Kanji Damage data from web')
-opt_parser.add_argument('-d', '--force-download', action='store_true', help='forces to download all images again')
-options = opt_parser.parse_args()
-if not options.file:
-    options.profile = options.profile or DEFAULT_ANKI_PROFILE
-    options.file = os.path.expanduser(os.path.join('~', DEFAULT_ANKI_DIR, options.profile, DEFAULT_ANKI_COL))
-
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG if options.verbose else logging.INFO)
-log.addHandler(logging.NullHandler() if options.quiet else logging.StreamHandler(sys.stdout))
+DEFAULT_ARCHIVE_FILE = 'pages.db'
+DEFAULT_TG_WORKERS = 4
+DEFAULT_KD_WORKERS = 4
+DEFAULT_RATE_LIMIT = 5.0
+DEFAULT_TAKE_N = 1
+DEFAULT_PARSE_WORKERS = 1
+DEFAULT_COMPRESSION = 6
+WF_FILE = 'word-freq.txt'
 
 
-##########################################
-# Functions.
-##########################################
+COMMANDS = ('run', 'fetch-tangorin', 'update-kd', 'build', 'export', 'verify-media', 'gc-media')
+
 
-# reads the word frequency file and returns a map that, for each word (that contains at least a kanji),
-# gives its frequency, normalized in [0,1] interval
-def load_word_freq(path):
-    log.info('loading word frequency file: %s', path)
+# parses a word frequency source option: PATH or PATH:WEIGHT
+def freq_source(value):
+    path, sep, weight = value.rpartition(':')
     try:
-        with codecs.open(path, 'r', 'utf-8') as f:
-            word_freq = {}
-            max_freq = float('-inf')
-            line = f.readline()
-            while line:
-                fields = line.split()
-                freq = abs(float(fields[1]))
-                word = fields[2]
-                if word in word_freq:
-                    log.debug("duplicate word '%s'", word)
-                elif util.KANJI_REGEX.search(word):
-                    word_freq[word] = freq
-                    max_freq = max(freq, max_freq)
-                line = f.readline()
-            for word in word_freq.keys():
-                word_freq[word] /= max_freq
-            return word_freq
-    except (FileNotFoundError, IOError):
-        log.info("couldn't load word frequency file: %s", path)
-    return {}
-
-
-# removes the previous 'kanji damage words' deck and model if it exists
-# then creates and return a referende to them (deck, model)
-def kdw_reset_model_and_deck(col):
-    util.remove_model_and_deck(col, KDW_MODEL, KDW_DECK, log)
-    deck_id = col.decks.id(KDW_DECK)
-    model = col.models.new(KDW_MODEL)
-    model['did'] = deck_id
-    model['css'] = util.load_file('kdw.css', log) or model['css']
-    col.models.add(model)
-
-    col.models.addField(model, col.models.newField('Kanji'))
-    col.models.addField(model, col.models.newField('Furigana'))
-    col.models.addField(model, col.models.newField('Meaning'))
-    col.models.addField(model, col.models.newField('Examples'))
-
-    tmpl_read = col.models.newTemplate('Read')
-    tmpl_read['qfmt'] = util.load_template_file('kdw', 'read', 'front', log) or ''
-    tmpl_read['afmt'] = util.load_template_file('kdw', 'read', 'back', log) or ''
-    tmpl_read['bqfmt'] = tmpl_read['qfmt']
-    tmpl_read['bafmt'] = tmpl_read['afmt']
-    col.models.addTemplate(model, tmpl_read)
-
-    tmpl_meaning = col.models.newTemplate('Meaning')
-    tmpl_meaning['qfmt'] = util.load_template_file('kdw', 'meaning', 'front', log) or ''
-    tmpl_meaning['afmt'] = util.load_template_file('kdw', 'meaning', 'back', log) or ''
-    tmpl_meaning['bqfmt'] = tmpl_meaning['qfmt']
-    tmpl_meaning['bafmt'] = tmpl_meaning['afmt']
-    col.models.addTemplate(model, tmpl_meaning)
-    col.save()
-
-    return model, col.decks.get(deck_id)
-
-
-# mergest the word databases created from kd and tangorin
-# the result will be a list of tuples (kanji, [word entries])
-# each word entry will be {
-#      'word': <in kanji>,
-#      'prefix': <prefix like wo or ga or empty>,
-#      'suffix': <suffix, like 'xxxx', de, ni or empty>,
-#      'furigana': <reading>,
-#      'meaning': <meaning>,
-#      'sort': <precedence of this word for this kanji, float, always present>,
-#      'sort2': <second level of precedence of this word for this kanji (sort is the same), float, may be absent>,
-# }
-def kdw_merge_kd_tg(kanjis_ordered, kd_kanji_to_words, tg_kanji_to_words, word_freq):
-    result = []
-
-    # makes a deep copy of a word entry from either database
-    def copy_entry(e):
-        new_e = copy.deepcopy(e)
-        new_e['prefix'] = e.get('prefix', '')
-        new_e['suffix'] = e.get('suffix', '')
-        return new_e
-
-    # checks if a tangorin entry's word matches the word in a kanji damage entry
-    # if it's the special case of 'お' prefix, updates the kanji_damage word
-    def word_match(kde, tge):
-        if kde['word'] == tge['word']:
-            return True
-        if kde['prefix'] == 'お':
-            honorific = 'お' + kde['word']
-            if honorific == tge:
-                kde['prefix'] = ''
-                kde['word'] = honorific
-                return True
-        return False
-
-    for kanji in kanjis_ordered:
-        entries = []
-
-        # add all kd entries using negative numbers for the sorting order
-        kd_entries = kd_kanji_to_words[kanji]
-        sort1 = -len(kd_entries)
-        while sort1 < 0:
-            entry = copy_entry(kd_entries[sort1])
-            entry['sort'] = sort1
-            entries.append(entry)
-            sort1 += 1
-
-        # now adds tangorin words
-        for reading, tg_entries in tg_kanji_to_words[kanji].items():
-            sort2 = 2
-            for tg_entry in tg_entries:
-                entry = next((e for e in entries if word_match(e, tg_entry)), None)
-                if entry:  # repeated?
-                    if 'sort2' not in entry:
-                        entry['meaning'] = '<p>' + tg_entry['meaning'] + '</p>' + entry['meaning']
-                        entry['sort2'] = sort2
-                else:
-                    entry = copy_entry(tg_entry)
-                    entry['sort'] = sort1
-                    entry['sort2'] = (1 - word_freq[entry['word']]) if entry['word'] in word_freq else sort2
-                    entries.append(entry)
-                sort2 += 1
-            sort1 += 1
-        result.append((kanji, entries))
-
-    return result
-
-
-# removes the previous 'kanji damage words' deck if it exists and creates
-# a new one
-def kdw_create(col, kd):
-    # word frequency handling
-    word_freq = load_word_freq('word-freq.txt')  # {word : frequency in [0,1]}
-    kd_kanji_to_words = kd.get_kanji_to_words()
-    kanjis_ordered = kd.get_kanjis_ordered()  # [kanji characters, ordered by due date]
-    tg_kanji_to_words = tg.get_kanji_to_words(TG_FILE, kanjis_ordered, log)  # {kanji : {reading : [words sorted by appearance]}}
-    kanji_words = kdw_merge_kd_tg(kanjis_ordered, kd_kanji_to_words, tg_kanji_to_words, word_freq)
-
-    final_entries = []
-    take_n = 1
-    for (kanji, words) in kanji_words:
-        # all required words have negative 'sort' values
-        main_words = sorted([w for w in words if w['sort'] < 0], key=itemgetter('sort'))
-        # now takes the ones with higher precedence from the other words
-        sort1_keys = set(map(lambda x: x['sort'], words))
-        word_groups = [
-            sorted([word for word in words if word['sort'] == key], key=itemgetter('sort2'))
-            for key in sort1_keys if key >= 0
-        ]
-        # puts all of them together
-        final_entries += main_words
-        for group in word_groups:
-            final_entries += [group[i] for i in range(0, take_n) if i < len(group)]  # take up to take_n first words
-
-    with codecs.open('entries.json', 'wb', encoding='utf-8') as f:
-        json.dump(final_entries, f, ensure_ascii=False, indent=4, sort_keys=True)
-
-    log.info("creating '%s' deck", KDW_DECK)
-    kdw_model, kdw_deck = kdw_reset_model_and_deck(col)
-    col.models.setCurrent(kdw_model)
-    col.decks.select(kdw_deck['id'])
-    col.conf['nextPos'] = 1
-
-    def create_affix_tag(affix):
-        return '(<span class="particles">' + affix + '</span>)' if affix else ''
-
-    log.info('%d word candidates will be processed', len(final_entries))
-    notes = {}
-    for entry in final_entries:
-        if entry['word'] in notes:
-            continue
-        note = col.newNote()
-        prefix = create_affix_tag(entry['prefix'])
-        suffix = create_affix_tag(entry['suffix'])
-        note['Kanji'] = prefix + entry['word'] + suffix
-        note['Furigana'] = prefix + entry['furigana'] + suffix
-        note['Meaning'] = entry['meaning']
-        note['Examples'] = ''
-        col.addNote(note)
-        notes[entry['word']] = note
-    col.save()
-    log.info('%d notes were created', len(notes))
-    return kdw_model, kdw_deck
+        return (path, float(weight)) if sep else (value, 1.0)
+    except ValueError:
+        return value, 1.0
+
+
+# adds an argument to parser, with suppress the argument is only set if it's given: the global options are added
+# to every command too, so they may come before or after it without the command's defaults replacing them
+def add_argument(parser, suppress, *flags, **kwargs):
+    if suppress:
+        if 'help' in kwargs:
+            kwargs['help'] = kwargs['help'].replace('%(default)s', str(kwargs.get('default')))
+        kwargs['default'] = argparse.SUPPRESS
+    parser.add_argument(*flags, **kwargs)
+
+
+def add_global_options(parser, suppress=False):
+    group_path = parser.add_mutually_exclusive_group()
+    add_argument(group_path, suppress, '-f', '--file', help='path to collection file (overwrites -p)',
+                 metavar="COLLECTION")
+    add_argument(group_path, suppress, '-p', '--profile',
+                 help='the Anki profile to be used (will use default Anki path)')
+    group_verb = parser.add_mutually_exclusive_group()
+    add_argument(group_verb, suppress, '-v', '--verbose', action='store_true', help='show detailed messages')
+    add_argument(group_verb, suppress, '-q', '--quiet', action='store_true', help='show no message')
+    add_argument(parser, suppress, '--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                 help='maximum requests per second to each site, 0 for no limit (default: %(default)s)', metavar='RPS')
+    add_argument(parser, suppress, '--archive', help='keeps a copy of every downloaded page in the archive at PATH',
+                 metavar='PATH')
+    add_argument(parser, suppress, '--offline', action='store_true',
+                 help='reads pages only from the archive, downloading nothing (use with -u to rebuild the '
+                      'KanjiDamage notes from the archived pages)')
+    add_argument(parser, suppress, '--profile-report',
+                 help='writes the time taken by each stage and the counters of downloads, cache hits and notes into a '
+                      'json report at PATH', metavar='PATH')
+    add_argument(parser, suppress, '--profile-dir',
+                 help='also runs each stage under cProfile, dumping its stats into DIR', metavar='DIR')
+
+
+def add_kd_options(parser):
+    parser.add_argument('-r', '--reset-kd', action='store_true', help='reimports Kanji Damage deck into the collection')
+    parser.add_argument('-k', '--kd-file', default=DEFAULT_KD_FILE, help='Kanji Damage deck file', metavar="APKG")
+    parser.add_argument('-d', '--verify-media', '--force-download', action='store_true', dest='verify_media',
+                        help='hashes the downloaded images first, downloading again the missing or corrupt ones')
+    parser.add_argument('--kd-workers', type=int, default=DEFAULT_KD_WORKERS,
+                        help='number of parallel KanjiDamage downloads, 1 to follow the site links one page at a time '
+                             '(default: %(default)s)', metavar='N')
+
+
+def add_tangorin_options(parser):
+    parser.add_argument('-j', '--tangorin-workers', type=int, default=DEFAULT_TG_WORKERS,
+                        help='number of parallel Tangorin downloads (default: %(default)s)', metavar='N')
+    parser.add_argument('--tangorin-max-age', type=float, help='fetches again Tangorin words older than DAYS',
+                        metavar='DAYS')
+    parser.add_argument('--refresh-tangorin', nargs='+', default=[],
+                        help='fetches again the Tangorin words of KANJI', metavar='KANJI')
+
+
+def add_words_options(parser):
+    parser.add_argument('--parse-workers', type=int, default=DEFAULT_PARSE_WORKERS,
+                        help='number of processes used to extract the words from the KanjiDamage notes '
+                             '(default: %(default)s)', metavar='N')
+    parser.add_argument('-n', '--take', type=int, default=DEFAULT_TAKE_N,
+                        help='number of extra words taken for each kanji reading (default: %(default)s)', metavar='N')
+    parser.add_argument('--freq-source', action='append', type=freq_source, dest='freq_sources',
+                        help='word frequency file used to rank the words, may be repeated to blend several files with '
+                             'the given weights (default: {0})'.format(WF_FILE), metavar='PATH[:WEIGHT]')
+
+
+def add_recreate_option(parser):
+    parser.add_argument('--recreate-kdw', action='store_true',
+                        help='deletes and recreates the whole KanjiDamage Words deck instead of only applying the '
+                             'changes to its notes (loses the review history)')
+
+
+def add_output_options(parser):
+    parser.add_argument('-o', '--output', default=DEFAULT_OUT_FILE, help='KanjiDamage Words output file',
+                        metavar="PATH")
+    parser.add_argument('--headless', action='store_true',
+                        help='opens the collection read only and builds the output file from scratch, without changing '
+                             'the collection')
+    parser.add_argument('--compression', type=int, choices=range(0, 10), default=DEFAULT_COMPRESSION,
+                        help='zlib compression level of the output file, 0 to store it uncompressed '
+                             '(default: %(default)s)', metavar='LEVEL')
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Generates Anki collections based on KanjiDamage deck.')
+    add_global_options(parser)
+    commands = parser.add_subparsers(
+        dest='command', metavar='COMMAND', help='{0} (default: run)'.format(', '.join(COMMANDS))
+    )
+
+    cmd = commands.add_parser('run', help='all steps: updates KanjiDamage (with -u), builds and exports the '
+                                          'KanjiDamage Words deck')
+    add_global_options(cmd, suppress=True)
+    cmd.add_argument('-u', '--update-kd', action='store_true', help='updates Kanji Damage data from web')
+    add_kd_options(cmd)
+    add_tangorin_options(cmd)
+    add_words_options(cmd)
+    add_recreate_option(cmd)
+    add_output_options(cmd)
+
+    cmd = commands.add_parser('fetch-tangorin', help='fetches the Tangorin words of the KanjiDamage kanjis into the '
+                                                     'cache (opens the collection read only)')
+    add_global_options(cmd, suppress=True)
+    add_tangorin_options(cmd)
+
+    cmd = commands.add_parser('update-kd', help='updates the KanjiDamage notes from the web')
+    add_global_options(cmd, suppress=True)
+    add_kd_options(cmd)
+
+    cmd = commands.add_parser('build', help='creates or updates the KanjiDamage Words deck in the collection')
+    add_global_options(cmd, suppress=True)
+    add_tangorin_options(cmd)
+    add_words_options(cmd)
+    add_recreate_option(cmd)
+
+    cmd = commands.add_parser('export', help='writes the KanjiDamage Words deck into the output file (with '
+                                             '--headless, builds it from scratch)')
+    add_global_options(cmd, suppress=True)
+    add_output_options(cmd)
+    add_tangorin_options(cmd)
+    add_words_options(cmd)
+
+    cmd = commands.add_parser('verify-media', help='checks the downloaded KanjiDamage images against the media '
+                                                   'manifest, downloading again the missing or corrupt ones')
+    add_global_options(cmd, suppress=True)
+    cmd.add_argument('--quick', action='store_true', help='only compares the sizes of the files, without hashing them')
+
+    cmd = commands.add_parser('gc-media', help='removes the downloaded images that no KanjiDamage note uses anymore')
+    add_global_options(cmd, suppress=True)
+    cmd.add_argument('--dry-run', action='store_true', help='only lists the files that would be removed')
+    return parser
+
+
+# parses the command line arguments, without a command runs all steps ('run', like older versions)
+def parse_options(args):
+    parser = create_parser()
+    if not any(a in COMMANDS for a in args) and not any(a in ('-h', '--help') for a in args):
+        args = ['run'] + args
+    parsed = parser.parse_args(args)
+    if getattr(parsed, 'freq_sources', False) is None:
+        parsed.freq_sources = [(WF_FILE, 1.0)]
+    if getattr(parsed, 'headless', False) and \
+            (getattr(parsed, 'reset_kd', False) or getattr(parsed, 'update_kd', False) or
+             getattr(parsed, 'recreate_kdw', False)):
+        parser.error('argument --headless: not allowed with -r, -u or --recreate-kdw')
+    if parsed.offline:
+        parsed.archive = parsed.archive or DEFAULT_ARCHIVE_FILE
+    if not parsed.file:
+        parsed.profile = parsed.profile or DEFAULT_ANKI_PROFILE
+        parsed.file = os.path.expanduser(os.path.join('~', DEFAULT_ANKI_DIR, parsed.profile, DEFAULT_ANKI_COL))
+    return parsed
+
+
+options = None  # parsed command line arguments, set by main
+log = logging.getLogger('anki-kanji')
 
 
 ##########################################
-# The script.
+# The commands.
 ##########################################
-def main():
-    # opens the collection
+
+# opens the collection, read only (see apkg.ReadOnlyCollection) or through anki
+def open_collection(read_only=False):
+    import apkg
     log.info('open collection: %s', options.file)
     cwd = os.getcwd()
-    col = anki.Collection(path=options.file)
-    work_dir = os.getcwd()
+    with profiling.span('open_collection'):
+        if read_only:
+            col = apkg.ReadOnlyCollection(options.file)
+        else:
+            import anki
+            col = anki.Collection(path=options.file)
     os.chdir(cwd)
+    return col
 
+
+# the kanji damage deck of the collection, reimported first with -r
+def load_kd(col):
+    from kanjidamage import KanjiDamage
     kd = KanjiDamage(col, log)
 
     # should update kanji damage deck?
-    if options.reset_kd:
-        kd.reset(options.kd_file)
+    if getattr(options, 'reset_kd', False):
+        with profiling.span('reset_kd'):
+            kd.reset(options.kd_file)
 
     # finds the kanji damage deck and model
     if not kd.get_deck():
@@ -263,40 +226,176 @@ def main():
                 'couldn\'t find KanjiDamage[ Reordered] deck in the collection, try using option -r to import it'
             )
         )
-    kd_model = kd.get_model()
-    if not kd_model:
+    if not kd.get_model():
         sys.exit(
             '{0}: error: {1}'.format(
                 sys.argv[0],
                 'couldn\'t find KanjiDamage model in the collection, try using option -r to import it'
             )
         )
+    return kd
+
+
+# updates kanji damage deck
+def update_kd(col, kd):
+    log.info('updating %s...', kd.get_model()['name'])
+    if options.verify_media:
+        verify_media(col.media.dir(), full=True)
+    with profiling.span('kd_update'):
+        kd.update(options.kd_workers)
+
+
+# checks the downloaded images against the media manifest (see media.MediaDownloader.verify_all)
+def verify_media(media_dir, full):
+    from media import MediaDownloader, MEDIA_MANIFEST_FILE
+    with profiling.span('verify_media'):
+        with MediaDownloader(MEDIA_MANIFEST_FILE, log, verify=full) as downloader:
+            checked, repaired, failed = downloader.verify_all(media_dir)
+    log.info('%d media files checked, %d repaired and %d failed', checked, repaired, failed)
+
+
+# the tangorin options, as the keyword arguments of kdw.fetch_tangorin
+def tangorin_options():
+    return {
+        'workers': options.tangorin_workers,
+        'max_age': options.tangorin_max_age * 24 * 60 * 60 if options.tangorin_max_age is not None else None,
+        'refresh': options.refresh_tangorin,
+    }
+
+
+# writes the kanji damage words deck into the output file, creating or updating it first if build is set
+# with --headless, the deck is built from scratch straight into the output file
+def export_kdw(col, kd, build):
+    import kdw
+    import apkg
+    if options.headless:
+        notes = kdw.kdw_notes(kd, options.take, options.freq_sources, options.parse_workers, tangorin_options())
+        log.info('writing output file %s...', options.output)
+        with profiling.span('export'):
+            apkg.build_package(
+                options.output, kdw.KDW_MODEL, kdw.KDW_DECK, kdw.kdw_model_spec(), list(notes.values()), log,
+                options.compression
+            )
+        return
 
-    # updates kanji damage deck
-    if options.update_kd:
-        log.info('updating %s...', kd_model['name'])
-        # removes media files
-        if options.force_download:
-            shutil.rmtree(os.path.join(col.media.dir(), 'assets'), ignore_errors=True)
-            shutil.rmtree(os.path.join(col.media.dir(), 'visualaids'), ignore_errors=True)
-        kd.update()
+    if build:
+        _, kdw_deck = kdw.kdw_create(
+            col, kd, options.recreate_kdw, options.take, options.freq_sources, options.parse_workers,
+            tangorin_options()
+        )
+    else:
+        kdw_deck = col.decks.byName(kdw.KDW_DECK)
+        if not kdw_deck:
+            sys.exit('{0}: error: couldn\'t find {1} deck in the collection, try the build command first'.format(
+                sys.argv[0], kdw.KDW_DECK
+            ))
+    log.info('writing output file %s...', options.output)
+    with profiling.span('export'):
+        apkg.export_deck(col, kdw_deck['id'], options.output, log, options.compression)
 
-    # recreates the kanji damage words deck
-    _, kdw_deck = kdw_create(col, kd)
 
-    log.info('writing output file %s...', options.output)
-    exporter = AnkiPackageExporter(col)
-    exporter.includeSched = False
-    exporter.includeMedia = True
-    exporter.includeTags = True
-    exporter.did = kdw_deck['id']
-
-    out_path = os.path.join(os.getcwd(), options.output)
-    os.chdir(work_dir)
-    exporter.exportInto(out_path)
+def run_all():
+    col = open_collection(read_only=options.headless)
+    kd = load_kd(col)
+    if options.update_kd:
+        update_kd(col, kd)
+    export_kdw(col, kd, build=True)
     log.info('all is well!')
     col.close()
 
 
+def run_fetch_tangorin():
+    import kdw
+    col = open_collection(read_only=True)
+    kanjis = load_kd(col).get_kanjis_ordered()
+    col.close()
+    with profiling.span('tangorin'):
+        kdw.fetch_tangorin(kanjis, **tangorin_options())
+
+
+def run_update_kd():
+    col = open_collection()
+    update_kd(col, load_kd(col))
+    col.close()
+
+
+def run_build():
+    import kdw
+    col = open_collection()
+    kdw.kdw_create(
+        col, load_kd(col), options.recreate_kdw, options.take, options.freq_sources, options.parse_workers,
+        tangorin_options()
+    )
+    col.close()
+
+
+def run_export():
+    col = open_collection(read_only=options.headless)
+    export_kdw(col, load_kd(col), build=False)
+    col.close()
+
+
+# the collection isn't opened, its media folder is found like anki does
+def run_verify_media():
+    verify_media(os.path.splitext(options.file)[0] + '.media', full=not options.quick)
+
+
+def run_gc_media():
+    import util
+    import media
+    col = open_collection()
+    kd = load_kd(col)
+    with profiling.span('gc_media'):
+        removed = media.collect_garbage(
+            media.MEDIA_MANIFEST_FILE, col.media.dir(), util.get_note_media(col, kd.get_model()),
+            util.get_note_media(col), log, options.dry_run
+        )
+    log.info('%d unused media files %s', len(removed), 'found' if options.dry_run else 'removed')
+    col.close()
+
+
+COMMAND_FUNCTIONS = {
+    'run': run_all,
+    'fetch-tangorin': run_fetch_tangorin,
+    'update-kd': run_update_kd,
+    'build': run_build,
+    'export': run_export,
+    'verify-media': run_verify_media,
+    'gc-media': run_gc_media,
+}
+
+
+##########################################
+# The script.
+##########################################
+def main():
+    global options
+    options = parse_options(sys.argv[1:])
+    log.setLevel(logging.DEBUG if options.verbose else logging.INFO)
+    log.addHandler(logging.NullHandler() if options.quiet else logging.StreamHandler(sys.stdout))
+
+    profiling.configure(options.profile_dir)
+    try:
+        _main()
+    finally:
+        if options.profile_report:
+            profiling.write_report(options.profile_report)
+            log.info('profile report written to %s', options.profile_report)
+
+
+def _main():
+    import util
+    util.configure_http(
+        max(getattr(options, 'tangorin_workers', 1), getattr(options, 'kd_workers', 1), util.HTTP_POOL_SIZE),
+        options.rate_limit or None
+    )
+    if options.archive:
+        util.configure_archive(options.archive, options.offline)
+        log.info('using page archive %s%s', options.archive, ' (offline)' if options.offline else '')
+
+    COMMAND_FUNCTIONS[options.command]()
+    util.close_archive()
+
+
 if __name__ == '__main__':
     main()
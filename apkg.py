@@ -0,0 +1,305 @@
+import os
+import os.path
+import re
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import unicodedata
+import zipfile
+from urllib.request import pathname2url
+import profiling
+import util
+
+
+APKG_COMPRESSION = 6  # zlib level of the package, 0 stores everything uncompressed
+# media that is already compressed, stored as is
+APKG_STORED_EXT = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.ogg', '.oga', '.m4a', '.mp4', '.webm', '.zip'}
+# files referenced by the css (url(...)) or the templates (src="..."), only '_' files are shared by a model
+APKG_MODEL_MEDIA_REGEX = re.compile(r'''url\(\s*['"]?([^'")]+)|src=["']([^"']+)''', re.IGNORECASE)
+APKG_SCHEMA_VERSION = 11
+# tables and indexes of an anki 2 collection (schema 11)
+APKG_SCHEMA = '''
+create table col (
+    id integer primary key, crt integer not null, mod integer not null, scm integer not null, ver integer not null,
+    dty integer not null, usn integer not null, ls integer not null, conf text not null, models text not null,
+    decks text not null, dconf text not null, tags text not null
+);
+create table notes (
+    id integer primary key, guid text not null, mid integer not null, mod integer not null, usn integer not null,
+    tags text not null, flds text not null, sfld integer not null, csum integer not null, flags integer not null,
+    data text not null
+);
+create table cards (
+    id integer primary key, nid integer not null, did integer not null, ord integer not null, mod integer not null,
+    usn integer not null, type integer not null, queue integer not null, due integer not null, ivl integer not null,
+    factor integer not null, reps integer not null, lapses integer not null, left integer not null,
+    odue integer not null, odid integer not null, flags integer not null, data text not null
+);
+create table revlog (
+    id integer primary key, cid integer not null, usn integer not null, ease integer not null, ivl integer not null,
+    lastIvl integer not null, factor integer not null, time integer not null, type integer not null
+);
+create table graves (usn integer not null, oid integer not null, type integer not null);
+create index ix_notes_usn on notes (usn);
+create index ix_cards_usn on cards (usn);
+create index ix_revlog_usn on revlog (usn);
+create index ix_cards_nid on cards (nid);
+create index ix_cards_sched on cards (did, queue, due);
+create index ix_revlog_cid on revlog (cid);
+create index ix_notes_csum on notes (csum);
+'''
+APKG_DEFAULT_CSS = '.card {\n font-family: arial;\n font-size: 20px;\n text-align: center;\n color: black;\n' \
+                   ' background-color: white;\n}\n'
+APKG_LATEX_PRE = '\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n' \
+                 '\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n' \
+                 '\\begin{document}\n'
+APKG_LATEX_POST = '\\end{document}'
+# default deck options of anki
+APKG_DECK_CONF = {
+    'id': 1, 'name': 'Default', 'dyn': False, 'mod': 0, 'usn': 0, 'maxTaken': 60, 'timer': 0, 'autoplay': True,
+    'replayq': True,
+    'new': {'delays': [1, 10], 'ints': [1, 4, 7], 'initialFactor': 2500, 'separate': True, 'order': 1, 'perDay': 20,
+            'bury': True},
+    'lapse': {'delays': [10], 'mult': 0, 'minInt': 1, 'leechFails': 8, 'leechAction': 0},
+    'rev': {'perDay': 200, 'ease4': 1.3, 'fuzz': 0.05, 'minSpace': 1, 'ivlFct': 1, 'maxIvl': 36500, 'bury': True,
+            'hardFactor': 1.2},
+}
+
+
+# the media files used by the notes of the cards cids and by their models, without listing the media folder
+# returns the names, relative to the media folder, of the files that exist
+def referenced_media(col, cids):
+    from anki.utils import ids2str
+    media_dir = col.media.dir()
+    names = set()
+    mids = set()
+    for mid, flds in col.db.all(
+            'select distinct n.mid, n.flds from notes n join cards c on c.nid = n.id where c.id in ' + ids2str(cids)
+    ):
+        mids.add(mid)
+        names.update(col.media.filesInStr(mid, flds))
+    for mid in mids:
+        model = col.models.get(mid)
+        texts = [model['css']] + [t[side] for t in model['tmpls'] for side in ('qfmt', 'afmt')]
+        for text in texts:
+            for match in APKG_MODEL_MEDIA_REGEX.finditer(text):
+                name = (match.group(1) or match.group(2)).strip()
+                if name.startswith('_'):
+                    names.add(name)
+    # files in subfolders aren't exported by anki either
+    return sorted(
+        name for name in names
+        if (name == os.path.basename(name)) and os.path.isfile(os.path.join(media_dir, name))
+    )
+
+
+# exports the deck did (and its children) of col into the package out_path, like anki's AnkiPackageExporter
+# but only the media referenced by the exported notes and models is included, found without listing the media
+# folder, and the files are streamed into the zip: already compressed media is stored, the rest is deflated with
+# the zlib level compression (0 stores everything)
+def export_deck(col, did, out_path, log, compression=APKG_COMPRESSION, include_sched=False, include_tags=True):
+    from anki.exporting import AnkiExporter
+    cwd = os.getcwd()  # opening the temporary collection changes the working directory
+    out_path = os.path.abspath(out_path)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(out_path), prefix='.apkg-')
+    try:
+        exporter = AnkiExporter(col)
+        exporter.includeSched = include_sched
+        exporter.includeMedia = False
+        exporter.includeTags = include_tags
+        exporter.did = did
+        col_file = os.path.join(tmp_dir, 'collection.anki2')
+        exporter.exportInto(col_file)
+
+        media_dir = col.media.dir()
+        files = referenced_media(col, exporter.cardIds())
+        log.info('exporting %d cards and %d media files', exporter.count, len(files))
+        profiling.count('export.media_files', len(files))
+        write_package(out_path, col_file, media_dir, files, compression)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# writes the package out_path from the collection file col_file and the media files (names in media_dir)
+def write_package(out_path, col_file, media_dir, files, compression=APKG_COMPRESSION):
+    deflated = zipfile.ZIP_DEFLATED if compression else zipfile.ZIP_STORED
+    tmp_path = out_path + '.tmp'
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', deflated, compresslevel=compression or None) as z:
+            z.write(col_file, 'collection.anki2')
+            media = {}
+            for i, name in enumerate(files):
+                ext = os.path.splitext(name)[1].lower()
+                z.write(
+                    os.path.join(media_dir, name), str(i),
+                    zipfile.ZIP_STORED if ext in APKG_STORED_EXT else deflated
+                )
+                media[str(i)] = unicodedata.normalize('NFC', name)
+            z.writestr('media', json.dumps(media))
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# read only access to an anki collection file, enough to load notes and cards (models, decks and the database),
+# without opening it through anki: nothing is locked, checked or written
+class ReadOnlyCollection:
+    def __init__(self, path):
+        self.path = path
+        self.db = ReadOnlyDB(path)
+        models, decks = self.db.first('select models, decks from col')
+        self.models = ReadOnlyModels(json.loads(models))
+        self.decks = ReadOnlyDecks(json.loads(decks))
+
+    def close(self):
+        self.db.close()
+
+
+# the subset of anki's DB used on collections opened by ReadOnlyCollection
+class ReadOnlyDB:
+    def __init__(self, path):
+        self._conn = sqlite3.connect('file:{0}?mode=ro'.format(pathname2url(os.path.abspath(path))), uri=True)
+
+    def close(self):
+        self._conn.close()
+
+    def all(self, sql, *args):
+        return self._conn.execute(sql, args).fetchall()
+
+    def first(self, sql, *args):
+        return self._conn.execute(sql, args).fetchone()
+
+    def scalar(self, sql, *args):
+        row = self.first(sql, *args)
+        return row[0] if row else None
+
+
+# the subset of anki's ModelManager used on collections opened by ReadOnlyCollection
+class ReadOnlyModels:
+    def __init__(self, models):
+        self._models = models  # {id : model}
+
+    def get(self, mid):
+        return self._models.get(str(mid))
+
+    def byName(self, name):
+        return next((m for m in self._models.values() if m['name'] == name), None)
+
+    def fieldNames(self, model):
+        return [f['name'] for f in model['flds']]
+
+    def fieldMap(self, model):
+        return {f['name']: (f['ord'], f) for f in model['flds']}
+
+    def sortIdx(self, model):
+        return model['sortf']
+
+
+# the subset of anki's DeckManager used on collections opened by ReadOnlyCollection
+class ReadOnlyDecks:
+    def __init__(self, decks):
+        self._decks = decks  # {id : deck}
+
+    def get(self, did):
+        return self._decks.get(str(did))
+
+    def byName(self, name):
+        return next((d for d in self._decks.values() if d['name'] == name), None)
+
+
+# a stable 64 bits number for a text, so a rebuilt package keeps the ids and guids of the previous one and
+# importing it again updates the notes instead of duplicating them
+def stable_id(text, bits=64):
+    return int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'big') >> (64 - bits)
+
+
+# a standard model named name, with the contents of spec (css, fields and templates, see kdw_model_spec)
+def new_model(name, spec, deck_id):
+    return {
+        'id': stable_id(name, 40),
+        'name': name,
+        'type': 0,
+        'mod': int(time.time()),
+        'usn': -1,
+        'sortf': 0,
+        'did': deck_id,
+        'css': spec['css'] or APKG_DEFAULT_CSS,
+        'latexPre': APKG_LATEX_PRE,
+        'latexPost': APKG_LATEX_POST,
+        'tags': [],
+        'vers': [],
+        'flds': [
+            {'name': field, 'ord': i, 'sticky': False, 'rtl': False, 'font': 'Arial', 'size': 20, 'media': []}
+            for i, field in enumerate(spec['fields'])
+        ],
+        'tmpls': [
+            {'name': tmpl, 'ord': i, 'qfmt': front, 'afmt': back, 'did': None, 'bqfmt': '', 'bafmt': ''}
+            for i, (tmpl, front, back) in enumerate(spec['templates'])
+        ],
+        'req': [[i, 'any', [0]] for i in range(len(spec['templates']))],  # recomputed by anki when imported
+    }
+
+
+def new_deck(deck_id, name):
+    return {
+        'id': deck_id, 'name': name, 'mod': int(time.time()), 'usn': -1, 'desc': '', 'dyn': 0, 'conf': 1,
+        'collapsed': False, 'browserCollapsed': False, 'extendNew': 10, 'extendRev': 50,
+        'newToday': [0, 0], 'revToday': [0, 0], 'lrnToday': [0, 0], 'timeToday': [0, 0],
+    }
+
+
+# builds the package out_path with a single deck and model from scratch, without opening an anki collection:
+# spec is the contents of the model (css, fields and templates, see kdw_model_spec) and notes a list of maps
+# {field name : value}, each note getting a new card for every template
+# the ids and guids are derived from the model name and the first field, so importing a rebuilt package
+# updates the notes imported before
+def build_package(out_path, model_name, deck_name, spec, notes, log, compression=APKG_COMPRESSION):
+    out_path = os.path.abspath(out_path)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(out_path), prefix='.apkg-')
+    try:
+        col_file = os.path.join(tmp_dir, 'collection.anki2')
+        note_count, card_count = build_collection(col_file, model_name, deck_name, spec, notes)
+        log.info('building %s with %d notes and %d cards', out_path, note_count, card_count)
+        write_package(out_path, col_file, tmp_dir, [], compression)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# writes the collection file col_file with a single deck and model, see build_package
+# returns the number of (notes, cards)
+def build_collection(col_file, model_name, deck_name, spec, notes):
+    deck_id = stable_id(deck_name, 48)
+    model = new_model(model_name, spec, deck_id)
+    names = spec['fields']
+    note_rows, card_rows, due = util.note_and_card_rows(
+        model, deck_id, names, 0, notes, nid=util.int_time(1000), cid=util.int_time(1000), due=1, usn=-1,
+        guid_of=lambda fields: util.base91(stable_id(model_name + util.FIELD_SEP + fields.get(names[0], '')))
+    )
+    now = util.int_time()
+    conf = {
+        'nextPos': due, 'estTimes': True, 'activeDecks': [1], 'sortType': 'noteFld', 'timeLim': 0,
+        'sortBackwards': False, 'addToCur': True, 'curDeck': 1, 'newBury': True, 'newSpread': 0,
+        'dueCounts': True, 'curModel': str(model['id']), 'collapseTime': 1200,
+    }
+    decks = {'1': new_deck(1, 'Default'), str(deck_id): new_deck(deck_id, deck_name)}
+
+    conn = sqlite3.connect(col_file)
+    try:
+        conn.executescript(APKG_SCHEMA)
+        conn.execute(
+            'insert into col values (1, ?, ?, ?, ?, 0, 0, 0, ?, ?, ?, ?, ?)',
+            (int(time.time()) // 86400 * 86400, now * 1000, now * 1000, APKG_SCHEMA_VERSION, json.dumps(conf),
+             json.dumps({str(model['id']): model}), json.dumps(decks), json.dumps({'1': APKG_DECK_CONF}), '{}')
+        )
+        conn.executemany('insert into notes values (?,?,?,?,?,?,?,?,?,?,?)', note_rows)
+        conn.executemany('insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', card_rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(note_rows), len(card_rows)
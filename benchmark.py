@@ -0,0 +1,783 @@
+# coding=utf-8
+import sys
+import re
+import os
+import os.path
+import glob
+import json
+import time
+import codecs
+import random
+import shutil
+import hashlib
+import argparse
+import logging
+import platform
+import tempfile
+import threading
+import statistics
+import functools
+import contextlib
+import subprocess
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import lxml.etree
+import lxml.html
+import util
+import kdw
+import kanjidamage
+import tangorin
+from kanjidamage import KanjiDamage
+from tangorin import Tangorin, TangorinCache
+
+
+# reproducible benchmark of the pipeline stages: builds a synthetic KanjiDamage collection for each scale
+# (BENCH_BASE_NOTES notes per scale unit), serves the page fixtures from a local stub site and times each stage,
+# comparing the times with a stored baseline and the generated notes with the golden output
+# the page fixtures in bench/fixtures are synthetic: hand-written pages following the markup the scrapers expect
+# from kanjidamage.com and tangorin.com, not copies of real pages (--record replaces them with real ones, the golden
+# output must then be recorded again)
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(ROOT_DIR, 'bench')
+KD_FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures', 'kanjidamage')
+TG_FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures', 'tangorin')
+DEFAULT_OUTPUT_FILE = 'bench_results.json'
+DEFAULT_BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_GOLDEN_FILE = os.path.join(BENCH_DIR, 'golden.json')
+DEFAULT_SCALES = [1, 5, 20]
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.25  # a stage slower than its baseline by more than this fraction is a regression
+DEFAULT_RECORD_PAGES = [1, 2, 3]
+BENCH_BASE_NOTES = 1000  # kanji damage notes of scale 1
+BENCH_PAGES = 50  # kanji damage pages crawled per scale unit
+BENCH_SEED = 20161017
+STARTUP_BUDGET = 0.5  # seconds 'anki-kanji.py -h' may take
+TEMPLATE_FILES = ['*.html', '*.css']  # files anki-kanji.py loads from the working directory
+KD_FIELDS = [
+    'Kanji', 'Meaning', 'Number', 'Description', 'Usefulness', 'Full used In', 'Full onyomi', 'Onyomi',
+    'Full kunyomi', 'First kunyomi', 'First kunyomi meaning', 'First kunyomi usefulness', 'Full mnemonic', 'Mnemonic',
+    'Components', 'Full jukugo', 'First jukugo', 'First jukugo meaning', 'First jukugo usefulness', 'Full header',
+    'Full lookalikes'
+]
+KD_FIXTURE_KANJI = re.compile('<span class="kanji_character">([^<]*)</span>')
+KD_FIXTURE_NEXT = re.compile(r'(<div class="span2 text-righted">)<a href="[^"]*">(.*?)</a>', re.S)
+KD_SITE_REGEX = re.compile(r'https?://(www\.)?kanjidamage\.com')
+TG_STUB_PATH = '/tangorin'
+STUB_IMAGE_EXT = ('.png', '.jpg', '.jpeg', '.gif', '.svg')
+STUB_IMAGE = (  # 1x1 transparent png, served for every image
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+    b'\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82'
+)
+KANJI_FIRST = 0x4e00  # the range of util.KANJI_REGEX
+KANJI_LAST = 0x9faf
+
+
+def parse_options(args):
+    parser = argparse.ArgumentParser(description='Times the anki-kanji stages on synthetic KanjiDamage collections.')
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='collection sizes, in units of {0} notes (default: %(default)s)'.format(BENCH_BASE_NOTES),
+                        metavar='N')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='times each stage is run, the fastest one is compared (default: %(default)s)', metavar='N')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT_FILE,
+                        help='json file receiving the results (default: %(default)s)', metavar='PATH')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_FILE,
+                        help='results the times are compared with (default: %(default)s)', metavar='PATH')
+    parser.add_argument('--update-baseline', action='store_true', help='stores the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='fraction a stage may be slower than its baseline (default: %(default)s)',
+                        metavar='FRACTION')
+    parser.add_argument('--golden', default=DEFAULT_GOLDEN_FILE,
+                        help='hashes of the expected KanjiDamage Words notes (default: %(default)s)', metavar='PATH')
+    parser.add_argument('--update-golden', action='store_true', help='stores the generated notes as the golden output')
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help='processes extracting the KanjiDamage words (default: %(default)s)', metavar='N')
+    parser.add_argument('--kd-workers', type=int, default=4,
+                        help='parallel KanjiDamage downloads (default: %(default)s)', metavar='N')
+    parser.add_argument('-j', '--tangorin-workers', type=int, default=4,
+                        help='parallel Tangorin downloads (default: %(default)s)', metavar='N')
+    parser.add_argument('-n', '--take', type=int, default=1,
+                        help='extra words taken for each kanji reading (default: %(default)s)', metavar='N')
+    parser.add_argument('--work-dir', help='keeps the synthetic collections in DIR instead of a temporary directory',
+                        metavar='DIR')
+    parser.add_argument('--record', action='store_true',
+                        help='downloads the page fixtures again from kanjidamage.com and tangorin.com and exits')
+    parser.add_argument('--record-pages', type=int, nargs='+', default=DEFAULT_RECORD_PAGES,
+                        help='KanjiDamage pages recorded by --record (default: %(default)s)', metavar='N')
+    parser.add_argument('--golden-only', action='store_true',
+                        help='only generates the KanjiDamage Words notes from the fixtures and compares them with the '
+                             'golden output (or records it), without anki')
+    parser.add_argument('--parsers-only', action='store_true',
+                        help='only times the page parsers against their previous implementations, without anki')
+    parser.add_argument('-v', '--verbose', action='store_true', help='shows the messages of the stages')
+    parsed = parser.parse_args(args)
+    max_scale = (KANJI_LAST - KANJI_FIRST + 1) // BENCH_BASE_NOTES
+    if any(s < 1 or s > max_scale for s in parsed.scales):
+        parser.error('argument --scales: must be between 1 and {0}'.format(max_scale))
+    if parsed.repeat < 1:
+        parser.error('argument --repeat: must be at least 1')
+    if parsed.parsers_only and (parsed.update_golden or parsed.golden_only):
+        parser.error('argument --parsers-only: not allowed with --update-golden or --golden-only')
+    return parsed
+
+
+options = None  # parsed command line arguments, set by main
+log = logging.getLogger('anki-kanji.bench')
+stage_log = logging.getLogger('anki-kanji.stages')  # given to the stages, only shown with -v
+
+
+##########################################
+# Fixtures and the stub site.
+##########################################
+
+# the page fixtures: kanji damage pages [(kanji, html)] and the tangorin page of tg_kanji
+# every page is served for any kanji by replacing its own kanji
+class Fixtures:
+    def __init__(self):
+        self.kd_pages = []
+        paths = glob.glob(os.path.join(KD_FIXTURES_DIR, '*.html'))
+        for path in sorted(paths, key=lambda p: int(os.path.splitext(os.path.basename(p))[0])):
+            html = read_file(path)
+            self.kd_pages.append((KD_FIXTURE_KANJI.search(html).group(1), html))
+        path = next(iter(sorted(glob.glob(os.path.join(TG_FIXTURES_DIR, '*.html')))))
+        self.tg_kanji = os.path.splitext(os.path.basename(path))[0]
+        self.tg_page = read_file(path)
+
+    # the kanji damage page number n (1 based) of a site with last_page pages, showing kanji
+    def kd_page(self, n, kanji, last_page):
+        fixture_kanji, html = self.kd_pages[(n - 1) % len(self.kd_pages)]
+        html = html.replace(fixture_kanji, kanji)
+        next_link = r'\1<a href="{0}/{1}">\2</a>'.format(kanjidamage.KD_KANJI_PATH, n + 1) if n < last_page else r'\1'
+        return KD_FIXTURE_NEXT.sub(next_link, html, count=1)
+
+    def kd_index(self, last_page):
+        links = ''.join(
+            '<li><a href="{0}/{1}">{1}</a></li>\n'.format(kanjidamage.KD_KANJI_PATH, n) for n in range(1, last_page + 1)
+        )
+        return '<html><body><ul>\n' + links + '</ul></body></html>'
+
+    def tg_page_of(self, kanji):
+        return self.tg_page.replace(self.tg_kanji, kanji)
+
+    # the tangorin words of kanji, as stored in the tangorin cache (see Tangorin._get_words_for_kanji)
+    def tg_words_of(self, kanji):
+        doc = lxml.html.fromstring(self.tg_page_of(kanji))
+        return dict(Tangorin._process_reading_row(tr) for tr in tangorin.TG_XP_ROWS(doc))
+
+
+# the pages of the stub site: kanji damage pages 1 to last_page (page n shows kanjis[n - 1]), the kanji index,
+# the tangorin page of every kanji and a tiny image for every image url
+class StubSite:
+    def __init__(self, fixtures, kanjis, last_page):
+        self.fixtures = fixtures
+        self.kanjis = kanjis
+        self.last_page = last_page
+
+    # (body, content type) of a path, None if it doesn't exist
+    def get(self, path):
+        path = unquote(path.split('?')[0])
+        if path == kanjidamage.KD_KANJI_PATH:
+            return self.fixtures.kd_index(self.last_page).encode('utf-8'), 'text/html; charset=utf-8'
+        m = kanjidamage.KD_PAGE_URL_REGEX.fullmatch(path)
+        if m and 1 <= int(m.group(1)) <= self.last_page:
+            n = int(m.group(1))
+            return self.fixtures.kd_page(n, self.kanjis[n - 1], self.last_page).encode('utf-8'), \
+                'text/html; charset=utf-8'
+        tg_prefix = TG_STUB_PATH + tangorin.TG_KANJI_PATH + '/'
+        if path.startswith(tg_prefix):
+            return self.fixtures.tg_page_of(path[len(tg_prefix):]).encode('utf-8'), 'text/html; charset=utf-8'
+        if path.lower().endswith(STUB_IMAGE_EXT):
+            return STUB_IMAGE, 'image/png'
+        return None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        page = self.server.site.get(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+        body, content_type = page
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# serves site on a local port and points the scrapers to it, until the returned server is shut down
+def start_stub(site):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.site = site
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    kanjidamage.KD_DAMAGE_BASE_URL = base_url
+    tangorin.TG_BASE_URL = base_url + TG_STUB_PATH
+    return server
+
+
+# downloads the page fixtures again, the links to the site are made relative so the stub serves them
+def record_fixtures(pages):
+    for n, number in enumerate(pages, 1):
+        url = kanjidamage.KD_DAMAGE_BASE_URL + kanjidamage.KD_KANJI_PATH + '/' + str(number)
+        log.info('recording %s', url)
+        r = util.http_get(url)
+        r.raise_for_status()
+        html = KD_SITE_REGEX.sub('', r.content.decode('utf-8'))
+        write_file(os.path.join(KD_FIXTURES_DIR, '{0}.html'.format(n)), html)
+    for path in glob.glob(os.path.join(KD_FIXTURES_DIR, '*.html')):
+        if int(os.path.splitext(os.path.basename(path))[0]) > len(pages):
+            os.remove(path)
+
+    kanji = Fixtures().kd_pages[0][0]
+    url = tangorin.TG_BASE_URL + tangorin.TG_KANJI_PATH + '/' + kanji
+    log.info('recording %s', url)
+    r = util.http_get(url)
+    r.raise_for_status()
+    for path in glob.glob(os.path.join(TG_FIXTURES_DIR, '*.html')):
+        os.remove(path)
+    write_file(os.path.join(TG_FIXTURES_DIR, kanji + '.html'), r.content.decode('utf-8'))
+
+
+def read_file(path):
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def write_file(path, content):
+    with codecs.open(path, 'wb', encoding='utf-8') as f:
+        f.write(content)
+
+
+##########################################
+# The synthetic collection.
+##########################################
+
+# count distinct kanjis, the same ones (in the same order) on every run
+def synthetic_kanjis(count):
+    kanjis = [chr(c) for c in range(KANJI_FIRST, KANJI_LAST + 1)]
+    random.Random(BENCH_SEED).shuffle(kanjis)
+    return kanjis[:count]
+
+
+# the note fields of each kanji damage fixture, as they're stored in the official deck: (fixture kanji, fields)
+def fixture_fields(fixtures):
+    result = []
+    for n, (kanji, html) in enumerate(fixtures.kd_pages, 1):
+        sections = KanjiDamage._scan_page(lxml.html.fromstring(html))
+        fields = {'Kanji': kanji, 'Meaning': sections['translation'].text_content().strip()}
+        for name, section in [
+            ('Description', 'description'), ('Full used In', 'used_in'), ('Full onyomi', 'Onyomi'),
+            ('Full kunyomi', 'Kunyomi'), ('Full mnemonic', 'Mnemonic'), ('Full jukugo', 'Jukugo')
+        ]:
+            if section in sections:
+                fields[name] = util.html_to_string(sections[section])
+        result.append((kanji, fields))
+    return result
+
+
+# creates a collection at path with the kanji damage model and deck, holding one note for each kanji
+# (see synthetic_notes)
+def create_collection(path, fixtures, kanjis):
+    import anki
+    cwd = os.getcwd()
+    col = anki.Collection(path=path)
+    os.chdir(cwd)
+
+    deck_id = col.decks.id(kanjidamage.KD_DECK_NAME)
+    model = col.models.new(kanjidamage.KD_MODEL)
+    model['did'] = deck_id
+    col.models.add(model)
+    for name in KD_FIELDS:
+        col.models.addField(model, col.models.newField(name))
+    tmpl = col.models.newTemplate(kanjidamage.KD_READ_TMPL)
+    tmpl['qfmt'] = '{{Kanji}}'
+    tmpl['afmt'] = '{{FrontSide}}<hr id="answer">{{Meaning}}'
+    col.models.addTemplate(model, tmpl)
+
+    util.add_notes_bulk(col, model, deck_id, synthetic_notes(fixtures, kanjis))
+    col.save()
+    return col
+
+
+# the fields of the kanji damage notes of kanjis: note n takes its fields from the fixture page n would show
+# on the stub site
+def synthetic_notes(fixtures, kanjis):
+    templates = fixture_fields(fixtures)
+    notes = []
+    for n, kanji in enumerate(kanjis, 1):
+        fixture_kanji, fields = templates[(n - 1) % len(templates)]
+        fields = {name: value.replace(fixture_kanji, kanji) for name, value in fields.items()}
+        fields['Number'] = str(n)
+        notes.append(fields)
+    return notes
+
+
+# a word frequency file with the words of the repository file plus the tangorin words of every kanji,
+# with (seeded) random frequencies, returns its sources as in kdw.load_word_freq
+def create_word_freq(path, fixtures, kanjis):
+    rng = random.Random(BENCH_SEED)
+    lines = read_file(os.path.join(ROOT_DIR, 'word-freq.txt')).splitlines()
+    words = [w['word'] for words in fixtures.tg_words_of(fixtures.tg_kanji).values() for w in words]
+    for kanji in kanjis:
+        for word in words:
+            word = word.replace(fixtures.tg_kanji, kanji)
+            lines.append('{0} {1} {2}'.format(len(lines) + 1, rng.randint(1, 50000), word))
+    write_file(path, '\n'.join(lines) + '\n')
+    return [(path, 1.0)]
+
+
+##########################################
+# Timing.
+##########################################
+
+# times fn 'repeat' times (calling setup, untimed, before each run) and keeps the results of a scale
+class Timer:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}  # {stage : {'min', 'median', 'samples'}}
+
+    def time(self, name, fn, setup=None, repeat=None):
+        samples = []
+        result = None
+        for _ in range(repeat or self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            result = fn()
+            samples.append(time.perf_counter() - start)
+        self.results[name] = {'min': min(samples), 'median': statistics.median(samples), 'samples': samples}
+        log.info('  %-24s %9.4fs (median %.4fs)', name, min(samples), statistics.median(samples))
+        return result
+
+
+# adds the notes (maps {field name : value}) of model to deck one at a time, with a newNote/addNote round-trip each
+def add_notes_per_note(col, model, deck, fields_list):
+    col.models.setCurrent(model)
+    col.decks.select(deck['id'])
+    for fields in fields_list:
+        note = col.newNote()
+        for name, value in fields.items():
+            note[name] = value
+        col.addNote(note)
+
+
+# (notes, cards) of a model
+def count_rows(col, model):
+    return (
+        col.db.scalar('select count() from notes where mid = ?', model['id']),
+        col.db.scalar('select count() from cards c join notes n on n.id = c.nid where n.mid = ?', model['id'])
+    )
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# sha1 of the kanji damage words notes, see kdw.kdw_notes
+def notes_digest(notes):
+    return hashlib.sha1(json.dumps(notes, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# runs every stage on a collection of scale * BENCH_BASE_NOTES notes inside work_dir
+# returns (the results of the stages, the golden output {'notes', 'sha1'}, the parsers' mismatches)
+def bench_scale(scale, fixtures, work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+    for pattern in TEMPLATE_FILES:
+        for path in glob.glob(os.path.join(ROOT_DIR, pattern)):
+            shutil.copy(path, work_dir)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    kanjis = synthetic_kanjis(scale * BENCH_BASE_NOTES)
+    last_page = scale * BENCH_PAGES
+    server = start_stub(StubSite(fixtures, kanjis, last_page))
+    timer = Timer(options.repeat)
+    col = None
+    try:
+        log.info('scale %d: %d notes, %d pages', scale, len(kanjis), last_page)
+        sources = create_word_freq(os.path.abspath('word-freq.txt'), fixtures, kanjis)
+        col = create_collection(os.path.abspath('collection.anki2'), fixtures, kanjis)
+        kd = KanjiDamage(col, stage_log)
+
+        # words
+        timer.time(
+            'word_freq_cold', lambda: kdw.load_word_freq(sources), setup=lambda: remove_file(kdw.WF_INDEX_FILE)
+        )
+        word_freq = timer.time('word_freq_warm', lambda: kdw.load_word_freq(sources))
+        kd_words = timer.time('kd_words_parse', lambda: kd.get_kanji_to_words(options.parse_workers, words_cache=None))
+        kd.get_kanji_to_words(options.parse_workers)  # fills the words cache
+        timer.time('kd_words_cached', lambda: kd.get_kanji_to_words(options.parse_workers))
+        kanjis_ordered = timer.time('kanjis_ordered', kd.get_kanjis_ordered)
+
+        # tangorin: the stub pages of the crawled kanjis are downloaded, the other ones are put in the cache
+        timer.time(
+            'tangorin_fetch', lambda: kdw.fetch_tangorin(kanjis_ordered[:last_page], workers=options.tangorin_workers),
+            setup=lambda: remove_file(kdw.TG_FILE)
+        )
+        with TangorinCache(kdw.TG_FILE, stage_log) as cache:
+            for kanji in kanjis_ordered[last_page:]:
+                cache.put(kanji, fixtures.tg_words_of(kanji))
+        tg_words = timer.time('tangorin_cached', lambda: kdw.fetch_tangorin(kanjis_ordered))
+
+        # deck
+        kanji_words = timer.time(
+            'merge', lambda: kdw.kdw_merge_kd_tg(kanjis_ordered, kd_words, tg_words, word_freq)
+        )
+        final_entries = timer.time('select', lambda: kdw.kdw_select_words(kanji_words, options.take))
+        notes = timer.time('entries_to_notes', lambda: kdw.kdw_entries_to_notes(final_entries))
+        kdw_model_deck = []
+
+        def reset_kdw():
+            kdw_model_deck[:] = kdw.kdw_reset_model_and_deck(col)
+
+        # the same notes added one at a time through anki, as before the bulk insert, and in bulk
+        fields_list = list(notes.values())
+        timer.time('add_notes_per_note', lambda: add_notes_per_note(col, *kdw_model_deck, fields_list), setup=reset_kdw)
+        per_note_rows = count_rows(col, kdw_model_deck[0])
+        timer.time(
+            'add_notes_bulk', lambda: util.add_notes_bulk(col, kdw_model_deck[0], kdw_model_deck[1]['id'], fields_list),
+            setup=reset_kdw
+        )
+        bulk_rows = count_rows(col, kdw_model_deck[0])
+        mismatches = []
+        if bulk_rows != per_note_rows:
+            mismatches.append('add_notes_bulk: {0} notes and {1} cards, one at a time {2} and {3}'.format(
+                bulk_rows[0], bulk_rows[1], per_note_rows[0], per_note_rows[1]
+            ))
+
+        timer.time('sync_notes_new', lambda: kdw.kdw_sync_notes(col, *kdw_model_deck, notes), setup=reset_kdw)
+        timer.time('sync_notes_unchanged', lambda: kdw.kdw_sync_notes(col, *kdw_model_deck, notes))
+        col.save()
+
+        mismatches += bench_parsers(timer, fixtures, kanjis, last_page)
+
+        # the golden output is taken before the update changes the notes
+        golden_notes = kdw.kdw_notes(kd, options.take, sources, options.parse_workers)
+        golden = {'notes': len(golden_notes), 'sha1': notes_digest(golden_notes)}
+
+        # the first update changes the crawled notes, the next ones find them unchanged
+        timer.time('kd_update_first', lambda: kd.update(options.kd_workers), repeat=1)
+        timer.time('kd_update_unchanged', lambda: kd.update(options.kd_workers))
+        return timer.results, golden, mismatches
+    finally:
+        if col is not None:
+            col.close()
+        server.shutdown()
+        server.server_close()
+        os.chdir(cwd)
+
+
+# times the page parsers on the stub pages of kanjis[:last_page], each one along with its previous implementation
+# (the '_before' stages, see the reference implementations below), whose output must be the same
+# returns the mismatches as messages
+def bench_parsers(timer, fixtures, kanjis, last_page):
+    mismatches = []
+
+    def compare(name, fn, reference_fn):
+        result = timer.time(name, fn)
+        if timer.time(name + '_before', reference_fn) != result:
+            mismatches.append('{0}: the output differs from the previous implementation'.format(name))
+
+    kd_pages = [fixtures.kd_page(n, kanjis[n - 1], last_page) for n in range(1, last_page + 1)]
+    tables = []
+    for page in kd_pages:
+        sections = KanjiDamage._scan_page(lxml.html.fromstring(page))
+        tables += [sections[name] for name in kanjidamage.KD_TABLE_SECTIONS if name in sections]
+    compare(
+        'html_to_string', lambda: [util.html_to_string(t) for t in tables],
+        lambda: [reference_html_to_string(t) for t in tables]
+    )
+
+    def parse_kd_pages():
+        return [parse_kd_page(p) for p in kd_pages]
+
+    def parse_kd_pages_uncompiled():
+        with uncompiled_xpaths():
+            return parse_kd_pages()
+
+    compare('kd_parse_pages', parse_kd_pages, parse_kd_pages_uncompiled)
+
+    tg_pages = [fixtures.tg_page_of(kanji) for kanji in kanjis[:last_page]]
+
+    def parse_tg_pages_uncompiled():
+        with uncompiled_xpaths():
+            return [
+                [reference_process_reading_row(tr) for tr in tangorin.TG_XP_ROWS(lxml.html.fromstring(p))]
+                for p in tg_pages
+            ]
+
+    compare('tg_parse_pages', lambda: [
+        [Tangorin._process_reading_row(tr) for tr in tangorin.TG_XP_ROWS(lxml.html.fromstring(p))]
+        for p in tg_pages
+    ], parse_tg_pages_uncompiled)
+    return mismatches
+
+
+# parses a kanji damage page as KanjiDamage._load_page does, except for the fields holding images (which would be
+# downloaded), returns the number, kanji, meaning, usefulness and words of the page
+def parse_kd_page(html):
+    doc = lxml.html.fromstring(html)
+    util.add_base_url(doc, kanjidamage.KD_DAMAGE_BASE_URL)
+    sections = KanjiDamage._scan_page(doc)
+    kanji = KanjiDamage._get_kanji(sections)
+    words = KanjiDamage._merge_words(
+        KanjiDamage._kunyomi_words(sections.get('Kunyomi'), kanji), KanjiDamage._jukugo_words(sections.get('Jukugo'))
+    )
+    return (
+        KanjiDamage._get_number(sections), kanji, KanjiDamage._get_meaning(sections),
+        KanjiDamage._get_usefulness(sections), words
+    )
+
+
+# times the parsers only, on scale * BENCH_PAGES pages, returns (the results of the stages, the mismatches)
+def bench_scale_parsers(scale, fixtures):
+    kanjis = synthetic_kanjis(scale * BENCH_BASE_NOTES)
+    last_page = scale * BENCH_PAGES
+    timer = Timer(options.repeat)
+    log.info('scale %d: %d pages (parsers only)', scale, last_page)
+    mismatches = bench_parsers(timer, fixtures, kanjis, last_page)
+    return timer.results, mismatches
+
+
+# the kanji damage words notes of a collection made by create_collection, as kdw.kdw_notes generates them from it
+# (its cards are due in the order of kanjis, all tangorin pages are the fixture's) but without the collection
+def golden_notes(fixtures, kanjis, sources):
+    kd_words = {
+        fields['Kanji']: kanjidamage.extract_note_words(fields['Kanji'], fields['Full kunyomi'], fields['Full jukugo'])
+        for fields in synthetic_notes(fixtures, kanjis)
+    }
+    tg_words = {kanji: fixtures.tg_words_of(kanji) for kanji in kanjis}
+    kanji_words = kdw.kdw_merge_kd_tg(kanjis, kd_words, tg_words, kdw.load_word_freq(sources))
+    return kdw.kdw_entries_to_notes(kdw.kdw_select_words(kanji_words, options.take))
+
+
+# the golden output of a scale, generated without anki (see golden_notes) inside work_dir
+def golden_scale(scale, fixtures, work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        kanjis = synthetic_kanjis(scale * BENCH_BASE_NOTES)
+        notes = golden_notes(fixtures, kanjis, create_word_freq(os.path.abspath('word-freq.txt'), fixtures, kanjis))
+        log.info('scale %d: %d notes', scale, len(notes))
+        return {'notes': len(notes), 'sha1': notes_digest(notes)}
+    finally:
+        os.chdir(cwd)
+
+
+# times 'anki-kanji.py -h', which must not load anki or the scrapers
+def bench_startup():
+    samples = []
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT_DIR, 'anki-kanji.py'), '-h'], stdout=subprocess.DEVNULL, check=True
+        )
+        samples.append(time.perf_counter() - start)
+    log.info('startup: %.4fs (budget %.2fs)', min(samples), STARTUP_BUDGET)
+    return {'min': min(samples), 'median': statistics.median(samples), 'samples': samples, 'budget': STARTUP_BUDGET}
+
+
+##########################################
+# Reference implementations.
+##########################################
+
+# the previous implementations of the parsers, kept as they were to measure the new ones against them
+
+# util.html_to_string before it returned the serializations without blanks as they are, with a single re.sub
+def reference_html_to_string(e):
+    html = lxml.html.tostring(e, encoding='unicode')
+    positions = []
+    src_re = re.compile('src="([^"])*"')
+    blank_re = re.compile('%20')
+    for match in src_re.finditer(html):
+        for blank in blank_re.finditer(html, match.start(), match.end()):
+            positions.append(blank.span())
+    components = []
+    first = 0
+    for pos in positions:
+        components.append(html[first:pos[0]])
+        components.append(' ')
+        first = pos[1]
+    components.append(html[first:])
+    return ''.join(components)
+
+
+# Tangorin._process_reading_row before it found the furigana and meaning of every word in a single pass
+def reference_process_reading_row(tr):
+    words = []
+    reading = str(tr.xpath('.//td[1]/span[@class="kana"]/b')[0].text).strip()
+    for a in tr.xpath('.//td[2]/a'):
+        word = ''.join(a.xpath('.//text()')).strip()
+        furigana = a.xpath('(./following-sibling::span[@class="kana"])[1]')[0].text.strip()
+        meaning = a.xpath('(./following-sibling::span[@class="romaji"])[1]')[0].tail.replace(u'】', '').strip()
+        words.append({'word': word, 'furigana': furigana, 'meaning': meaning})
+    return reading, words
+
+
+def _evaluate_xpath(path, e):
+    return e.xpath(path)
+
+
+# makes the scrapers evaluate their xpath expressions from the source on every call, as they did before
+# the expressions were compiled once at module level
+@contextlib.contextmanager
+def uncompiled_xpaths():
+    compiled = [
+        (module, name, value) for module in (kanjidamage, tangorin, util) for name, value in vars(module).items()
+        if isinstance(value, lxml.etree.XPath)
+    ]
+    for module, name, xpath in compiled:
+        setattr(module, name, functools.partial(_evaluate_xpath, xpath.path))
+    try:
+        yield
+    finally:
+        for module, name, xpath in compiled:
+            setattr(module, name, xpath)
+
+
+##########################################
+# Comparisons.
+##########################################
+
+def load_json(path):
+    try:
+        with codecs.open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, IOError):
+        return None
+
+
+def save_json(path, data):
+    with codecs.open(path, 'wb', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4, sort_keys=True)
+
+
+# adds the baseline time and the ratio to the results of each stage, returns the regressions as messages
+def compare_baseline(results, baseline):
+    regressions = []
+    for scale, stages in results['scales'].items():
+        for name, result in stages.items():
+            base = baseline.get('scales', {}).get(scale, {}).get(name)
+            if not base:
+                continue
+            result['baseline'] = base['min']
+            result['ratio'] = result['min'] / base['min'] if base['min'] else 1.0
+            if result['ratio'] > 1 + options.tolerance:
+                regressions.append('scale {0} {1}: {2:.4f}s, baseline {3:.4f}s ({4:+.0%})'.format(
+                    scale, name, result['min'], base['min'], result['ratio'] - 1
+                ))
+    return regressions
+
+
+# returns the scales whose notes differ from the golden output, as messages
+def compare_golden(goldens, expected):
+    mismatches = []
+    for scale, golden in goldens.items():
+        if scale not in expected:
+            log.info('no golden output for scale %s, run with --update-golden to record it', scale)
+        elif expected[scale] != golden:
+            mismatches.append('scale {0}: {1} notes with sha1 {2}, expected {3} notes with sha1 {4}'.format(
+                scale, golden['notes'], golden['sha1'], expected[scale]['notes'], expected[scale]['sha1']
+            ))
+    return mismatches
+
+
+##########################################
+# The script.
+##########################################
+def main():
+    global options
+    options = parse_options(sys.argv[1:])
+    logging.getLogger('anki-kanji').addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    stage_log.setLevel(logging.INFO if options.verbose else logging.WARNING)
+    logging.getLogger('anki-kanji.kdw').setLevel(logging.INFO if options.verbose else logging.WARNING)
+    util.configure_http(max(options.kd_workers, options.tangorin_workers, util.HTTP_POOL_SIZE))
+
+    if options.record:
+        record_fixtures(options.record_pages)
+        return 0
+
+    fixtures = Fixtures()
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='anki-kanji-bench-')
+    if options.golden_only:
+        try:
+            goldens = {
+                str(scale): golden_scale(scale, fixtures, os.path.join(work_dir, 'scale-{0}'.format(scale)))
+                for scale in options.scales
+            }
+        finally:
+            if not options.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        return report(update_golden(goldens))
+
+    results = {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeat': options.repeat,
+        'scales': {},
+    }
+    goldens = {}
+    failures = []
+    try:
+        for scale in options.scales:
+            if options.parsers_only:
+                stages, mismatches = bench_scale_parsers(scale, fixtures)
+            else:
+                stages, goldens[str(scale)], mismatches = bench_scale(
+                    scale, fixtures, os.path.join(work_dir, 'scale-{0}'.format(scale))
+                )
+            results['scales'][str(scale)] = stages
+            failures += ['scale {0} {1}'.format(scale, mismatch) for mismatch in mismatches]
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    results['startup'] = bench_startup()
+    results['golden'] = goldens
+
+    if results['startup']['min'] > STARTUP_BUDGET:
+        failures.append('startup: {0:.4f}s, budget {1:.2f}s'.format(results['startup']['min'], STARTUP_BUDGET))
+
+    if options.update_baseline:
+        save_json(options.baseline, results)
+        log.info('baseline written to %s', options.baseline)
+    else:
+        baseline = load_json(options.baseline)
+        if baseline is None:
+            log.info('no baseline at %s, run with --update-baseline to record one', options.baseline)
+        else:
+            failures += compare_baseline(results, baseline)
+
+    failures += update_golden(goldens)
+    save_json(options.output, results)
+    log.info('results written to %s', options.output)
+    return report(failures)
+
+
+# records the golden output of the scales with --update-golden, otherwise returns their mismatches
+def update_golden(goldens):
+    if not options.update_golden:
+        return compare_golden(goldens, load_json(options.golden) or {})
+    expected = load_json(options.golden) or {}
+    expected.update(goldens)
+    save_json(options.golden, expected)
+    log.info('golden output written to %s', options.golden)
+    return []
+
+
+def report(failures):
+    for failure in failures:
+        log.error('FAILED %s', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
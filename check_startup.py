@@ -0,0 +1,152 @@
+# coding=utf-8
+import re
+import sys
+import glob
+import shutil
+import os.path
+import time
+import logging
+import tempfile
+import subprocess
+import importlib.util
+import apkg
+import kdw
+import kanjidamage
+import benchmark
+from tangorin import TangorinCache
+
+
+# checks that the commands which don't need anki start fast: 'anki-kanji.py -h', the help of every command,
+# a 'verify-media' run on an empty media manifest, and an 'export --headless' run and a 'fetch-tangorin' run served
+# from the tangorin cache on a read only fixture collection (see create_fixture) must not import anki (nor the
+# scrapers' dependencies for the help), and each must run within its time budget (the best of CHECK_REPEAT runs,
+# measured without -X importtime, which slows the imports down)
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_FILE = os.path.join(ROOT_DIR, 'anki-kanji.py')
+CHECK_REPEAT = 5
+CHECK_NOTES = 200  # kanji damage notes of the fixture collection
+HELP_BUDGET = 0.5  # seconds
+VERIFY_MEDIA_BUDGET = 1.0  # seconds
+EXPORT_BUDGET = 2.0  # seconds
+FETCH_TANGORIN_BUDGET = 1.0  # seconds
+HELP_FORBIDDEN = ('anki', 'lxml', 'requests')  # top level packages the help must not import
+RUN_FORBIDDEN = ('anki',)  # top level packages the runs must not import
+IMPORT_TIME_REGEX = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+log = logging.getLogger('anki-kanji.check')
+
+
+def load_commands():
+    spec = importlib.util.spec_from_file_location('anki_kanji', SCRIPT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.COMMANDS
+
+
+# runs the script with -X importtime, returns {top level package : cumulative import time in seconds}
+def imported_packages(args, cwd):
+    r = subprocess.run(
+        [sys.executable, '-X', 'importtime', SCRIPT_FILE] + args, cwd=cwd,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if r.returncode != 0:
+        raise RuntimeError('{0} failed: {1}'.format(' '.join(args), r.stderr[-2000:]))
+    packages = {}
+    for line in r.stderr.splitlines():
+        match = IMPORT_TIME_REGEX.match(line)
+        if match:
+            package = match.group(4).split('.')[0]
+            packages[package] = max(packages.get(package, 0.0), int(match.group(2)) / 1e6)
+    return packages
+
+
+# the best wall time of CHECK_REPEAT runs of the script
+def run_time(args, cwd):
+    samples = []
+    for _ in range(CHECK_REPEAT):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SCRIPT_FILE] + args, cwd=cwd, stdout=subprocess.DEVNULL, check=True)
+        samples.append(time.perf_counter() - start)
+    return min(samples)
+
+
+# a kanji damage collection of CHECK_NOTES notes made from the benchmark's page fixtures (see
+# benchmark.synthetic_notes), written without anki, with the files a headless export reads from the working
+# directory: the templates, the word frequencies and the tangorin words of every kanji, so nothing is downloaded
+def create_fixture(work_dir):
+    fixtures = benchmark.Fixtures()
+    kanjis = benchmark.synthetic_kanjis(CHECK_NOTES)
+    spec = {
+        'css': None,
+        'fields': benchmark.KD_FIELDS,
+        'templates': [[kanjidamage.KD_READ_TMPL, '{{Kanji}}', '{{FrontSide}}<hr id="answer">{{Meaning}}']],
+    }
+    col_file = os.path.join(work_dir, 'collection.anki2')
+    apkg.build_collection(
+        col_file, kanjidamage.KD_MODEL, kanjidamage.KD_DECK_NAME, spec, benchmark.synthetic_notes(fixtures, kanjis)
+    )
+    for pattern in benchmark.TEMPLATE_FILES:
+        for path in glob.glob(os.path.join(ROOT_DIR, pattern)):
+            shutil.copy(path, work_dir)
+    benchmark.create_word_freq(os.path.join(work_dir, 'word-freq.txt'), fixtures, kanjis)
+    with TangorinCache(os.path.join(work_dir, kdw.TG_FILE), log) as cache:
+        for kanji in kanjis:
+            cache.put(kanji, fixtures.tg_words_of(kanji))
+    return col_file
+
+
+def check(args, cwd, forbidden, budget):
+    failures = []
+    name = ' '.join(args)
+    packages = imported_packages(args, cwd)
+    for package in forbidden:
+        if package in packages:
+            failures.append('{0}: imports {1} ({2:.3f}s)'.format(name, package, packages[package]))
+    elapsed = run_time(args, cwd)
+    log.info('%s: %.3fs (budget %.2fs), %d packages imported', name, elapsed, budget, len(packages))
+    if elapsed > budget:
+        failures.append('{0}: {1:.3f}s, budget {2:.2f}s'.format(name, elapsed, budget))
+    return failures
+
+
+# the fetch-tangorin runs must not have stored anything: every kanji of the fixture is in the cache
+def check_cache_only(work_dir, started):
+    kanjis = benchmark.synthetic_kanjis(CHECK_NOTES)
+    with TangorinCache(os.path.join(work_dir, kdw.TG_FILE), log) as cache:
+        entries = cache.get_many(kanjis)
+    fetched = [kanji for kanji in kanjis if (kanji not in entries) or (entries[kanji].fetched >= started)]
+    if fetched:
+        return ['fetch-tangorin: {0} kanjis fetched instead of read from the cache'.format(len(fetched))]
+    return []
+
+
+def main():
+    logging.getLogger('anki-kanji').addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='anki-kanji-check-') as work_dir:
+        failures += check(['-h'], work_dir, HELP_FORBIDDEN, HELP_BUDGET)
+        for command in load_commands():
+            failures += check([command, '-h'], work_dir, HELP_FORBIDDEN, HELP_BUDGET)
+        # the media manifest is created empty in the working directory
+        col_file = create_fixture(work_dir)
+        failures += check(['verify-media', '-q', '-f', col_file], work_dir, RUN_FORBIDDEN, VERIFY_MEDIA_BUDGET)
+        output = os.path.join(work_dir, 'KanjiDamageWords.apkg')
+        failures += check(
+            ['export', '--headless', '--offline', '-q', '-f', col_file, '-o', output], work_dir, RUN_FORBIDDEN,
+            EXPORT_BUDGET
+        )
+        started = time.time()
+        failures += check(
+            ['fetch-tangorin', '--offline', '-q', '-f', col_file], work_dir, RUN_FORBIDDEN, FETCH_TANGORIN_BUDGET
+        )
+        failures += check_cache_only(work_dir, started)
+    for failure in failures:
+        log.error('FAILED %s', failure)
+    if not failures:
+        log.info('all checks passed')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# coding=utf-8
+import sys
+import os.path
+import time
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import util
+import tangorin
+from tangorin import Tangorin
+import benchmark
+
+
+# checks the concurrent tangorin fetch against a local stub site (serving the benchmark's tangorin fixture):
+# the words must come back in the order of the kanjis even when the responses arrive in a different order,
+# and the requests to each host must respect the rate limit (see util.RateLimiter) without slowing other hosts
+CHECK_KANJIS = 8
+CHECK_DELAY = 0.05  # seconds, the first kanji is answered last: (CHECK_KANJIS - position) * CHECK_DELAY
+CHECK_RATE = 10.0  # requests per second of the rate limit check
+CHECK_RATE_REQUESTS = 6
+CHECK_RATE_JITTER = 0.03  # seconds a request may reach the stub late (thread scheduling)
+
+log = logging.getLogger('anki-kanji.check')
+
+
+class CheckHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        kanji = unquote(self.path.split('?')[0]).rsplit('/', 1)[-1]
+        with server.lock:
+            server.started.append((self.headers.get('Host'), time.monotonic()))
+        time.sleep(server.delays.get(kanji, 0.0))
+        body = server.fixtures.tg_page_of(kanji).encode('utf-8')
+        with server.lock:
+            server.answered.append(kanji)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(fixtures):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CheckHandler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    server.lock = threading.Lock()
+    server.delays = {}  # {kanji : seconds before answering}
+    server.started = []  # [(host header, time)] of every request
+    server.answered = []  # kanjis in the order they were answered
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# the words must follow the order of the kanjis, whatever the order the pages arrive
+def check_order(server, work_dir):
+    failures = []
+    kanjis = benchmark.synthetic_kanjis(CHECK_KANJIS)
+    server.delays = {kanji: (CHECK_KANJIS - i) * CHECK_DELAY for i, kanji in enumerate(kanjis)}
+    util.configure_http(CHECK_KANJIS)
+    kanji_to_words = Tangorin.get_kanji_to_words(
+        os.path.join(work_dir, 'order.db'), kanjis, log, workers=CHECK_KANJIS
+    )
+    if server.answered == kanjis:
+        failures.append('order: the stub answered in order, the check proves nothing')
+    if list(kanji_to_words) != kanjis:
+        failures.append('order: got {0}, expected {1}'.format(''.join(kanji_to_words), ''.join(kanjis)))
+    for kanji in kanjis:
+        if kanji_to_words.get(kanji) != server.fixtures.tg_words_of(kanji):
+            failures.append('order: wrong words for {0}'.format(kanji))
+    log.info('order: answered %s, returned %s', ''.join(server.answered), ''.join(kanji_to_words))
+    return failures
+
+
+# the n-th request to a host starts at least n / CHECK_RATE seconds after the first one (the limiter hands out fixed
+# slots, so a request arriving late shortens the gap to the next one), requests to another host aren't delayed
+def check_rate(server):
+    failures = []
+    port = server.server_address[1]
+    hosts = ['127.0.0.1:{0}'.format(port), 'localhost:{0}'.format(port)]
+    kanjis = benchmark.synthetic_kanjis(CHECK_RATE_REQUESTS)
+    server.delays = {}
+    server.started = []
+    util.configure_http(CHECK_RATE_REQUESTS * len(hosts), CHECK_RATE)
+    urls = [
+        'http://{0}{1}{2}/{3}'.format(host, benchmark.TG_STUB_PATH, tangorin.TG_KANJI_PATH, kanji)
+        for kanji in kanjis for host in hosts
+    ]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        statuses = list(executor.map(lambda url: util.http_get(url).status_code, urls))
+    elapsed = time.monotonic() - start
+    if any(status != 200 for status in statuses):
+        failures.append('rate: failed requests {0}'.format(statuses))
+
+    interval = 1.0 / CHECK_RATE
+    for host in hosts:
+        times = sorted(t for h, t in server.started if h == host)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        log.info('rate: %s gaps %s', host, ', '.join('{0:.3f}'.format(g) for g in gaps))
+        if len(times) != CHECK_RATE_REQUESTS:
+            failures.append('rate: {0} got {1} requests, expected {2}'.format(host, len(times), CHECK_RATE_REQUESTS))
+            continue
+        early = max(n * interval - (t - times[0]) for n, t in enumerate(times))
+        if early > CHECK_RATE_JITTER:
+            failures.append('rate: {0} requests {1:.3f}s ahead of the limit of one every {2:.3f}s'.format(
+                host, early, interval
+            ))
+    # the hosts are limited independently, so both run in the time of one
+    limit = (CHECK_RATE_REQUESTS - 1) * interval * 1.5 + 0.5
+    if elapsed > limit:
+        failures.append('rate: {0:.3f}s for both hosts, the hosts slow down each other ({1:.3f}s max)'.format(
+            elapsed, limit
+        ))
+    return failures
+
+
+def main():
+    logging.getLogger('anki-kanji').addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    fixtures = benchmark.Fixtures()
+    server = start_server(fixtures)
+    tangorin.TG_BASE_URL = 'http://127.0.0.1:{0}{1}'.format(server.server_address[1], benchmark.TG_STUB_PATH)
+    try:
+        with tempfile.TemporaryDirectory(prefix='anki-kanji-check-') as work_dir:
+            failures = check_order(server, work_dir) + check_rate(server)
+    finally:
+        server.shutdown()
+        server.server_close()
+    for failure in failures:
+        log.error('FAILED %s', failure)
+    if not failures:
+        log.info('all checks passed')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,20 @@
 import re
 import os.path
-import requests
+import time
+import json
+import hashlib
+import inspect
+import sqlite3
+import threading
+import functools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import lxml
+import lxml.etree
 import lxml.html
-from anki.importing import AnkiPackageImporter
+from media import MediaDownloader, MEDIA_MANIFEST_FILE
 import util
+import profiling
 
 
 KD_DECK_NAME = 'KanjiDamage'
@@ -15,11 +25,145 @@ KD_VALID_KANJI = re.compile(util.KANJI_REGEX_STR + '|L|￥|(<<<)|丶|' + util.KA
 KD_NUMBER_STRIP_REGEX = re.compile('([a-zA-Z]|\s)+')
 KD_DAMAGE_BASE_URL = 'http://www.kanjidamage.com'
 KD_KANJI_PATH = '/kanji'
+KD_PAGE_URL_REGEX = re.compile(KD_KANJI_PATH + r'/(\d+)')
+KD_PARALLEL_MIN_NOTES = 200  # below this, the notes are parsed serially
+KD_PARALLEL_CHUNKS_PER_WORKER = 4
+KD_WORDS_CACHE = 'kd_words.db'
+KD_WORDS_CACHE_MAX = 20000  # entries kept in the words cache, the least recently used ones are evicted
+KD_SQL_CHUNK = 500  # max number of sqlite parameters per query
+# precompiled xpath expressions
+KD_XP_HREFS = lxml.etree.XPath('//a/@href')
+KD_XP_H1_SPANS = lxml.etree.XPath('./h1/span')
+KD_XP_TEXTS = lxml.etree.XPath('./text()')
+KD_XP_IMAGES = lxml.etree.XPath('descendant-or-self::img')
+KD_XP_FLAG = lxml.etree.XPath('./img[@alt="Flag"]')
+KD_XP_USEFULNESS = lxml.etree.XPath('./span[@class="usefulness-stars"]/text()')
+KD_XP_NODES = lxml.etree.XPath('./node()')
+KD_XP_ONYOMI = lxml.etree.XPath('./tr[1]/td[1]/span[@class="onyomi"]/text()')
+KD_XP_FIRST_WORD = lxml.etree.XPath('./tr[1]/td[1]/node()')
+KD_XP_KUN_MEANING = lxml.etree.XPath('./tr[1]/td[2]/text()[1]')
+KD_XP_KUN_USEFULNESS = lxml.etree.XPath('./tr[1]/td[2]/span[@class="usefulness-stars"]/text()')
+KD_XP_MNEMONIC = lxml.etree.XPath('./tr[1]/td[2]/p/node()')
+KD_XP_NEXT_ELEMENTS = lxml.etree.XPath('./following-sibling::*')
+KD_XP_JK_MEANING = lxml.etree.XPath('./tr[1]/td[2]/p/text()[1]')
+KD_XP_JK_USEFULNESS = lxml.etree.XPath('./tr[1]/td[2]/p/span[@class="usefulness-stars"]/text()')
+KD_XP_ROWS = lxml.etree.XPath('.//tr')
+KD_XP_ROW_MEANING = lxml.etree.XPath('td[2]/node()')
+KD_XP_JK_WORD = lxml.etree.XPath('td[1]//ruby[1]/text()')
+KD_XP_JK_FURIGANA = lxml.etree.XPath('td[1]//ruby[1]/rt/text()')
+KD_XP_KUN_WORD = lxml.etree.XPath('td[1]//text()')
 # don't touch these strings!
 ORD_JAP_BASE = ord('！')
 ORD_JAP_TOP = ord('～')
 ORD_ASCII_BASE = ord('!')
 ORD_JAP_SP = ord('　')
+# japanese full width letters (and space) to ascii
+KD_JAP_ASCII_TABLE = {n: chr(ORD_ASCII_BASE + n - ORD_JAP_BASE) for n in range(ORD_JAP_BASE, ORD_JAP_TOP + 1)}
+KD_JAP_ASCII_TABLE[ORD_JAP_SP] = ' '
+KD_JAP_ASCII_REGEX = re.compile('[' + chr(ORD_JAP_BASE) + '-' + chr(ORD_JAP_TOP) + chr(ORD_JAP_SP) + ']')
+KD_JAP_ASCII_SEP = '\x00'  # never found in html text
+
+
+# one parsed kanji damage page:
+# key is the note key (see get_notes) or None if the page must be ignored, fields maps note fields to their values
+# media lists the files used by the fields as (download future, local path, name used in the fields)
+# words are the word examples of the page (see get_kanji_to_words), extracted from the parsed tables
+KDPage = namedtuple('KDPage', ['url', 'key', 'kanji', 'fields', 'media', 'next_url', 'words'])
+KD_TABLE_SECTIONS = ('Onyomi', 'Kunyomi', 'Mnemonic', 'Jukugo')
+KD_SECTIONS = KD_TABLE_SECTIONS + ('Lookalikes',)
+
+
+# read only view of a note's fields, loaded in bulk without building anki Note objects
+class NoteView:
+    __slots__ = ('id', '_fields', '_field_map')
+
+    def __init__(self, nid, fields, field_map):
+        self.id = nid
+        self._fields = fields
+        self._field_map = field_map  # {field name : index}
+
+    def __getitem__(self, name):
+        return self._fields[self._field_map[name]]
+
+    def __contains__(self, name):
+        return name in self._field_map
+
+    def keys(self):
+        return list(self._field_map.keys())
+
+    def items(self):
+        return [(name, self._fields[i]) for name, i in self._field_map.items()]
+
+
+# persistent cache of the words extracted from the notes, keyed by a hash of the fields they're extracted from
+# (see words_key), so only the notes changed since the last run are parsed again
+# the cache is emptied when the words extraction changes (see words_version) and keeps at most max_entries,
+# evicting the least recently used
+class WordsCache:
+    def __init__(self, path, log, max_entries=KD_WORDS_CACHE_MAX):
+        self.path = path
+        self.log = log
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute(
+            'create table if not exists words (key text primary key, data text not null, used real not null)'
+        )
+        self.conn.execute('create table if not exists meta (key text primary key, value text not null)')
+        row = self.conn.execute("select value from meta where key = 'version'").fetchone()
+        version = words_version()
+        if (row is None) or (row[0] != version):
+            if row is not None:
+                log.info('the words extraction changed since words cache %s was written, clearing it', path)
+            self.conn.execute('delete from words')
+            self.conn.execute("insert or replace into meta (key, value) values ('version', ?)", (version,))
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('select count(*) from words').fetchone()[0]
+
+    # loads the requested keys, returns a map {key : words} and marks them as used
+    def get_many(self, keys):
+        keys = list(keys)
+        result = {}
+        for i in range(0, len(keys), KD_SQL_CHUNK):
+            chunk = keys[i:i + KD_SQL_CHUNK]
+            rows = self.conn.execute(
+                'select key, data from words where key in ({0})'.format(','.join('?' * len(chunk))), chunk
+            )
+            for key, data in rows:
+                result[key] = json.loads(data)
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('update words set used = ? where key = ?', ((now, key) for key in result))
+        return result
+
+    # stores the words of many keys, given as a map {key : words}, then evicts the entries over max_entries
+    def put_many(self, key_to_words):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                'insert or replace into words (key, data, used) values (?, ?, ?)',
+                ((key, json.dumps(words, ensure_ascii=False), now) for key, words in key_to_words.items())
+            )
+            self.conn.execute(
+                'delete from words where key not in (select key from words order by used desc limit ?)',
+                (self.max_entries,)
+            )
+
+
+# the key of a note's words in WordsCache: a hash of the fields they're extracted from
+def words_key(kanji, kunyomi, jukugo):
+    return hashlib.sha1(json.dumps([kanji, kunyomi, jukugo], ensure_ascii=False).encode('utf-8')).hexdigest()
 
 
 class KanjiDamage:
@@ -28,12 +172,17 @@ class KanjiDamage:
         self.log = log
         self.model = None
         self.deck = None
+        self._local = threading.local()  # per thread state of the page being parsed
+        self._media = None  # MediaDownloader, while updating
+        self._media_dir = None
+        self._page_words = {}  # {kanji or meaning : words} extracted by the last update
 
     def reset(self, path):
         self.log.info('removing previous Kanji Damage decks')
         util.remove_model_and_deck(self.col, KD_MODEL, KD_DECK_NAME, self.log)
         util.remove_model_and_deck(self.col, KD_MODEL, KDR_DECK_NAME, self.log)
         self.log.info('importing %s', path)
+        from anki.importing import AnkiPackageImporter
         importer = AnkiPackageImporter(self.col, path)
         importer.run()
         self.col.save()
@@ -52,21 +201,35 @@ class KanjiDamage:
     def get_kanjis_ordered(self):
         kd_model = self.get_model()
         kd_deck = self.get_deck()
-        nids = self.col.db.list(
-            'select nid from cards where did={0} and ord={1} order by due'.format(
-                kd_deck['id'],
-                next((x['ord'] for x in kd_model['tmpls'] if x['name'] == KD_READ_TMPL))
-            )
+        kanji_index = self._field_map()['Kanji']
+        rows = self.col.db.all(
+            'select n.flds from cards c join notes n on n.id = c.nid where c.did = ? and c.ord = ? order by c.due',
+            kd_deck['id'],
+            next((x['ord'] for x in kd_model['tmpls'] if x['name'] == KD_READ_TMPL))
         )
         kanjis = []  # kanjis in order of due date
-        for nid in nids:
-            kanji = self.col.getNote(nid)['Kanji']
+        for flds, in rows:
+            kanji = util.split_fields(flds)[kanji_index]
             if not util.KANJI_REGEX.match(kanji):
                 continue
             kanjis.append(kanji)
         return kanjis
 
-    def update(self):
+    # maps the kanji damage model field names to their index in the notes
+    def _field_map(self):
+        return {name: index for name, (index, _) in self.col.models.fieldMap(self.get_model()).items()}
+
+    # loads the fields of all kanji damage notes (see util.get_note_fields), returns a list of NoteView
+    def get_note_views(self):
+        field_map = self._field_map()
+        return [NoteView(nid, values, field_map) for nid, values in util.get_note_fields(self.col, self.get_model())]
+
+    # updates the notes from kanji damage website
+    # with workers <= 1 the pages are visited one at a time following the 'next' links,
+    # otherwise the page urls are discovered first and fetched by 'workers' threads,
+    # while the notes are only written by the calling thread
+    # images are downloaded in background (see MediaDownloader), using media_cache to avoid unneeded downloads
+    def update(self, workers=1, media_cache=MEDIA_MANIFEST_FILE):
         model = self.get_model()
         deck = self.get_deck()
         note_map = self.get_notes()
@@ -78,83 +241,212 @@ class KanjiDamage:
         self.log.info('loading data from kanji damage website (this will take quite a while)...')
         self.col.models.setCurrent(model)
         self.col.decks.select(deck['id'])
-        url = KD_DAMAGE_BASE_URL + KD_KANJI_PATH + '/1'
-        tries = 0
-        while url:
-            try:
-                doc = util.get_html(url, self.log)
-                if doc is None:
-                    return
-                util.add_base_url(doc, KD_DAMAGE_BASE_URL)
-
-                # retrieves the data
-                kanji = self._get_kanji(doc)
-                meaning = self._get_meaning(doc)
-
-                # get map key
-                key = None
-                if type(kanji) is lxml.html.HtmlElement:
-                    # kanji is an image
-                    self._download_images(kanji, KD_DAMAGE_BASE_URL)
-                    kanji = util.html_to_string(kanji)
-                    key = meaning
-                elif KD_VALID_KANJI.match(kanji):
-                    key = kanji
-
-                # update/create note
-                if key:
-                    note = note_map[key] if key in note_map else self.col.newNote()
-                    note['Kanji'] = kanji
-                    note['Meaning'] = meaning
-                    note['Number'] = self._get_number(doc)
-                    note['Description'] = self._get_description(doc, KD_DAMAGE_BASE_URL)
-                    note['Usefulness'] = self._get_usefulness(doc)
-                    note['Full used In'] = self._get_used_in(doc, KD_DAMAGE_BASE_URL)
-                    onyomi_full, onyomi = self._get_onyomi(doc, KD_DAMAGE_BASE_URL)
-                    note['Full onyomi'] = onyomi_full
-                    note['Onyomi'] = onyomi
-                    kun_full, kun, kun_meaning, kun_use = self._get_kunyomi(doc, KD_DAMAGE_BASE_URL)
-                    note['Full kunyomi'] = kun_full
-                    note['First kunyomi'] = kun
-                    note['First kunyomi meaning'] = kun_meaning
-                    note['First kunyomi usefulness'] = kun_use
-                    mnemonic_full, mnemonic = self._get_mnemonic(doc, KD_DAMAGE_BASE_URL)
-                    note['Full mnemonic'] = mnemonic_full
-                    note['Mnemonic'] = mnemonic
-                    note['Components'] = self._get_components(doc, KD_DAMAGE_BASE_URL)
-                    jk_full, jk, jk_meaning, jk_use = self._get_jukugo(doc, KD_DAMAGE_BASE_URL)
-                    note['Full jukugo'] = jk_full
-                    note['First jukugo'] = jk
-                    note['First jukugo meaning'] = jk_meaning
-                    note['First jukugo usefulness'] = jk_use
-                    note['Full header'] = self._get_header(doc, KD_DAMAGE_BASE_URL)
-                    note['Full lookalikes'] = self._get_lookalikes(doc, KD_DAMAGE_BASE_URL)
-
-                    if key not in note_map:
-                        self.col.addNote(note)
-                        note_map[key] = note
-                    else:
-                        note.flush()
-                    self.log.debug(util.note_to_json(note))
-                else:
-                    self.log.info('ignored kanji: %s', kanji)
-
-                # finds the link to the next kanji
-                url = next(iter(doc.xpath('//div[@class="span2 text-righted"]/a[1]/@href')), None)
-                tries = 0
-            except OSError as e:
-                if (e.errno == 101) and (tries < 3):
-                    tries += 1
-                else:
-                    self.log.exception('failed to retrieve from %s', url)
-                    url = None
+        self._media_dir = self.col.media.dir()
+        with MediaDownloader(media_cache, self.log) as self._media:
+            if workers <= 1:
+                url = KD_DAMAGE_BASE_URL + KD_KANJI_PATH + '/1'
+                while url:
+                    page = self._load_page(url)
+                    if page is None:
+                        break
+                    self._apply_page(page, note_map)
+                    url = page.next_url
+            else:
+                urls = self._discover_urls(note_map)
+                self.log.info('crawling %d pages using %d workers', len(urls), workers)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for page in executor.map(self._load_page, urls):
+                        if page is not None:
+                            self._apply_page(page, note_map)
+        self._media = None
         self.col.save()
 
-    # retrieves all notes in a map where the key is either the kanji character (if a valid KD kanji) or the meaning
+    # lists the urls of all kanji pages, from the kanji index page or, if it can't be used,
+    # from the range of numbers of the notes already in the collection
+    def _discover_urls(self, note_map):
+        numbers = set()
+        try:
+            doc = util.get_html(KD_DAMAGE_BASE_URL + KD_KANJI_PATH, self.log)
+            if doc is not None:
+                for href in KD_XP_HREFS(doc):
+                    m = KD_PAGE_URL_REGEX.search(href)
+                    if m:
+                        numbers.add(int(m.group(1)))
+        except util.HTTP_RETRY_ERRORS:
+            self.log.exception('failed to load the kanji index')
+        if not numbers:
+            self.log.info('using the note numbers to find the kanji pages')
+            last = max((int(n['Number']) for n in note_map.values() if n['Number'].isdigit()), default=0)
+            numbers = range(1, last + 1)
+        return [KD_DAMAGE_BASE_URL + KD_KANJI_PATH + '/' + str(n) for n in sorted(numbers)]
+
+    # downloads and parses one kanji page, doesn't touch the collection so it can run on any thread
+    # returns a KDPage or None if the page couldn't be loaded
+    def _load_page(self, url):
+        try:
+            doc = util.get_html(url, self.log)
+        except util.HTTP_RETRY_ERRORS:
+            self.log.exception('failed to retrieve from %s', url)
+            return None
+        if doc is None:
+            return None
+        util.add_base_url(doc, KD_DAMAGE_BASE_URL)
+        sections = self._scan_page(doc)
+
+        # finds the link to the next kanji
+        next_url = sections['next'].get('href') if 'next' in sections else None
+
+        self._local.media = []
+        try:
+            key, kanji, fields, words = self._extract_fields(sections)
+        except Exception:
+            self.log.exception('failed to parse %s', url)
+            key, kanji, fields, words = None, url, {}, None
+        return KDPage(url, key, kanji, fields, self._local.media, next_url, words)
+
+    # walks the page once and returns a map with the elements of each part of the page:
+    # 'header' (first span8 div), 'kanji' and 'translation' (spans of the header's h1), 'number', 'usefulness',
+    # 'description', 'used_in', 'next' (link to the next page), the definition table following each of the
+    # KD_TABLE_SECTIONS headers and the 'Lookalikes' h2 header; missing parts aren't in the map
+    @staticmethod
+    def _scan_page(doc):
+        sections = {}
+        for e in doc.iter('div', 'ul', 'h2'):
+            cls = e.get('class')
+            if e.tag == 'div':
+                if cls == 'span8':
+                    sections.setdefault('header', e)
+                    for span in KD_XP_H1_SPANS(e):
+                        span_cls = span.get('class')
+                        if span_cls == 'kanji_character':
+                            sections.setdefault('kanji', span)
+                        elif span_cls == 'translation':
+                            sections.setdefault('translation', span)
+                elif cls == 'span8 text-centered':
+                    sections.setdefault('number', e)
+                elif cls == 'span4 text-righted':
+                    sections.setdefault('usefulness', e)
+                elif cls == 'span2 text-righted':
+                    a = e.find('a')
+                    if (a is not None) and ('next' not in sections):
+                        sections['next'] = a
+                elif cls == 'description':
+                    sections.setdefault('description', e)
+            elif e.tag == 'ul':
+                if cls == 'lacidar':
+                    sections.setdefault('used_in', e)
+            else:
+                texts = KD_XP_TEXTS(e)
+                for name in KD_SECTIONS:
+                    if (name in sections) or (name not in texts):
+                        continue
+                    if name in KD_TABLE_SECTIONS:
+                        table = next((t for t in e.itersiblings('table') if t.get('class') == 'definition'), None)
+                        if table is not None:
+                            sections[name] = table
+                    else:
+                        sections[name] = e
+        return sections
+
+    # retrieves the note key, the kanji, the note fields and the word examples from the sections of a kanji page
+    def _extract_fields(self, sections):
+        kanji = self._get_kanji(sections)
+        meaning = self._get_meaning(sections)
+
+        # get map key
+        key = None
+        if type(kanji) is lxml.html.HtmlElement:
+            # kanji is an image
+            self._download_images(kanji, KD_DAMAGE_BASE_URL)
+            kanji = util.html_to_string(kanji)
+            key = meaning
+        elif KD_VALID_KANJI.match(kanji):
+            key = kanji
+        if not key:
+            return None, kanji, {}, None
+
+        fields = dict()
+        fields['Kanji'] = kanji
+        fields['Meaning'] = meaning
+        fields['Number'] = self._get_number(sections)
+        fields['Description'] = self._get_description(sections, KD_DAMAGE_BASE_URL)
+        fields['Usefulness'] = self._get_usefulness(sections)
+        fields['Full used In'] = self._get_used_in(sections, KD_DAMAGE_BASE_URL)
+        onyomi_full, onyomi = self._get_onyomi(sections, KD_DAMAGE_BASE_URL)
+        fields['Full onyomi'] = onyomi_full
+        fields['Onyomi'] = onyomi
+        kun_full, kun, kun_meaning, kun_use = self._get_kunyomi(sections, KD_DAMAGE_BASE_URL)
+        fields['Full kunyomi'] = kun_full
+        fields['First kunyomi'] = kun
+        fields['First kunyomi meaning'] = kun_meaning
+        fields['First kunyomi usefulness'] = kun_use
+        mnemonic_full, mnemonic = self._get_mnemonic(sections, KD_DAMAGE_BASE_URL)
+        fields['Full mnemonic'] = mnemonic_full
+        fields['Mnemonic'] = mnemonic
+        fields['Components'] = self._get_components(sections, KD_DAMAGE_BASE_URL)
+        jk_full, jk, jk_meaning, jk_use = self._get_jukugo(sections, KD_DAMAGE_BASE_URL)
+        fields['Full jukugo'] = jk_full
+        fields['First jukugo'] = jk
+        fields['First jukugo meaning'] = jk_meaning
+        fields['First jukugo usefulness'] = jk_use
+        fields['Full header'] = self._get_header(sections, KD_DAMAGE_BASE_URL)
+        fields['Full lookalikes'] = self._get_lookalikes(sections, KD_DAMAGE_BASE_URL)
+
+        # the word examples come from the tables already parsed (their images were handled by the fields above)
+        words = self._merge_words(
+            self._kunyomi_words(sections.get('Kunyomi'), kanji), self._jukugo_words(sections.get('Jukugo'))
+        )
+        return key, kanji, fields, words
+
+    # writes a parsed page into its note (creating it if needed), must run on the collection's thread
+    def _apply_page(self, page, note_map):
+        if not page.key:
+            self.log.info('ignored kanji: %s', page.kanji)
+            return
+        fields = page.fields
+        words = page.words
+        for future, local_path, name in page.media:
+            if not future.result():
+                continue
+            media_name = self._media.register(self.col, local_path)
+            if media_name != name:
+                # anki renamed the file, fixes the references (html_to_string turns %20 into blanks)
+                old_src = 'src="{0}"'.format(name.replace('%20', ' '))
+                new_src = 'src="{0}"'.format(media_name.replace('%20', ' '))
+                fields = {k: v.replace(old_src, new_src) for k, v in fields.items()}
+                if words is not None:
+                    words = [{k: v.replace(old_src, new_src) for k, v in word.items()} for word in words]
+
+        key = page.key
+        if words is not None:
+            self._page_words[page.fields['Kanji'] if util.KANJI_REGEX.match(page.fields['Kanji']) else
+                             page.fields['Meaning']] = words
+        if key in note_map:
+            # only builds the full note if something changed
+            current = note_map[key]
+            if all((field in current) and (current[field] == value) for field, value in fields.items()):
+                self.log.debug('unchanged: %s', key)
+                profiling.count('kd.notes_unchanged')
+                return
+            note = self.col.getNote(current.id)
+        else:
+            note = self.col.newNote()
+        for field, value in fields.items():
+            note[field] = value
+        if key not in note_map:
+            self.col.addNote(note)
+            profiling.count('kd.notes_added')
+        else:
+            note.flush()
+            profiling.count('kd.notes_updated')
+        note_map[key] = note
+        self.log.debug(util.note_to_json(note))
+
+    # retrieves all notes (as NoteView) in a map where the key is either the kanji character (if a valid KD kanji)
+    # or the meaning
     def get_notes(self, expr=KD_VALID_KANJI):
         kanjis_by_text = {}
-        for note_id in self.col.models.nids(self.get_model()):
-            note = self.col.getNote(note_id)
+        for note in self.get_note_views():
             key = note['Kanji'] if expr.match(note['Kanji']) else note['Meaning']
             if key in kanjis_by_text:
                 raise KeyError('duplicate note key: {0}'.format(key))
@@ -177,27 +469,19 @@ class KanjiDamage:
                                '  zoom: 1.5;\n}'
         self.col.models.save(kd_model)
 
-    # downloads a file inside collection's media path
-    def _download_file(self, path, base_url, cached=True):
+    # schedules the download of a file inside collection's media path, returns the name it will have there
+    def _download_file(self, path, base_url):
         sub_dir, fn = os.path.split(path)
-        sub_dir = self.col.media.dir() + sub_dir
-        if not os.path.exists(sub_dir):
-            os.makedirs(sub_dir)
-        local_path = os.path.join(sub_dir, fn)
-        if cached and os.path.exists(local_path):
-            self.log.debug('[cached]: %s', local_path)
-        else:
-            r = requests.get(base_url + path, stream=True)
-            with open(local_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-            self.log.debug('[download]: %s', local_path)
-        return self.col.media.addFile(local_path)
+        local_path = os.path.join(self._media_dir + sub_dir, fn)
+        future = self._media.fetch(base_url + path, local_path)
+        # the file is added to the collection later by _apply_page, using the name anki usually gives it
+        name = os.path.basename(local_path)
+        self._local.media.append((future, local_path, name))
+        return name
 
     def _download_images(self, doc, base_url):
         paths = []
-        for img in doc.xpath('descendant-or-self::img'):
+        for img in KD_XP_IMAGES(doc):
             src = img.get('src')
             if src.startswith('/'):
                 src = self._download_file(src, base_url)
@@ -217,10 +501,12 @@ class KanjiDamage:
 
     # tries to extract the kd kanji number, otherwise raises
     @staticmethod
-    def _get_number(doc):
-        number = next(iter(doc.xpath('//div[@class="span8 text-centered"]/img[@alt="Flag"]')), None)
-        number = number.tail if (number is not None) \
-            else next(iter(doc.xpath('//div[@class="span8 text-centered"]/text()')), None)
+    def _get_number(sections):
+        number = None
+        div = sections.get('number')
+        if div is not None:
+            flag = next(iter(KD_XP_FLAG(div)), None)
+            number = flag.tail if (flag is not None) else next(iter(KD_XP_TEXTS(div)), None)
         if number:
             number = KD_NUMBER_STRIP_REGEX.sub("", number)
             int(number)
@@ -230,93 +516,94 @@ class KanjiDamage:
 
     # tries to extract the kd kanji, otherwise raises
     @staticmethod
-    def _get_kanji(doc):
-        kanji = next(iter(doc.xpath('//div[@class="span8"]/h1/span[@class="kanji_character"]/img[1]')), None)
+    def _get_kanji(sections):
+        span = sections['kanji']
+        kanji = span.find('img')
         if kanji is not None:
             return kanji
         else:
-            return str(next(iter(doc.xpath('//div[@class="span8"]/h1/span[@class="kanji_character"]/text()')))).strip()
+            return str(next(iter(KD_XP_TEXTS(span)))).strip()
 
     # tries to extract the kd kanji meaning, otherwise raises
     @staticmethod
-    def _get_meaning(doc):
-        return str(next(iter(doc.xpath('//div[@class="span8"]/h1/span[@class="translation"]/text()')))).strip()
+    def _get_meaning(sections):
+        return str(next(iter(KD_XP_TEXTS(sections['translation'])))).strip()
 
     # tries to extract the kd kanji description, otherwise returns the empty string
     @staticmethod
-    def _get_usefulness(doc):
-        return str(
-            next(iter(doc.xpath('//div[@class="span4 text-righted"]/span[@class="usefulness-stars"]/text()')), '')
-        ).strip()
+    def _get_usefulness(sections):
+        div = sections.get('usefulness')
+        if div is None:
+            return ''
+        return str(next(iter(KD_XP_USEFULNESS(div)), '')).strip()
 
     # tries to extract the kd kanji description, otherwise returns the empty string
-    def _get_description(self, doc, base_url):
-        path = '(//div[@class="description"])[1]/node()'
-        return self._nodes_to_string(doc.xpath(path), base_url)
+    def _get_description(self, sections, base_url):
+        div = sections.get('description')
+        return self._nodes_to_string(KD_XP_NODES(div) if div is not None else [], base_url)
 
     # tries to extract the kd kanji 'used in field', otherwise returns the empty string
-    def _get_used_in(self, doc, base_url):
-        path = '(//ul[@class="lacidar"])[1]'
-        return self._nodes_to_string(doc.xpath(path), base_url)
+    def _get_used_in(self, sections, base_url):
+        ul = sections.get('used_in')
+        return self._nodes_to_string([ul] if ul is not None else [], base_url)
 
     # tries to extract the kd kanji onyomi, otherwise returns the empty string
-    def _get_onyomi(self, doc, base_url):
-        table = next(iter(doc.xpath('(//h2[text()="Onyomi"]/following-sibling::table[@class="definition"])[1]')), None)
+    def _get_onyomi(self, sections, base_url):
+        table = sections.get('Onyomi')
         if table is None:
             return '', ''
-        content = str(next(iter(table.xpath('./tr[1]/td[1]/span[@class="onyomi"]/text()')), ''))
+        content = str(next(iter(KD_XP_ONYOMI(table)), ''))
         full = self._nodes_to_string([table], base_url)
         return full, content
 
     # tries to extract the kd kanji kunyomi, otherwise returns the empty string
-    def _get_kunyomi(self, doc, base_url):
-        table = next(iter(doc.xpath('(//h2[text()="Kunyomi"]/following-sibling::table[@class="definition"])[1]')), None)
+    def _get_kunyomi(self, sections, base_url):
+        table = sections.get('Kunyomi')
         if table is None:
             return '', '', '', ''
         full = self._nodes_to_string([table], base_url)
-        kun = self._nodes_to_string(table.xpath('./tr[1]/td[1]/node()'), base_url)
-        kun_meaning = str(next(iter(table.xpath('./tr[1]/td[2]/text()[1]')), '')).strip()
-        kun_use = str(next(iter(table.xpath('./tr[1]/td[2]/span[@class="usefulness-stars"]/text()')), '')).strip()
+        kun = self._nodes_to_string(KD_XP_FIRST_WORD(table), base_url)
+        kun_meaning = str(next(iter(KD_XP_KUN_MEANING(table)), '')).strip()
+        kun_use = str(next(iter(KD_XP_KUN_USEFULNESS(table)), '')).strip()
         return full, kun, kun_meaning, kun_use
 
     # tries to extract the kd kanji mnemonic, otherwise returns the empty string
-    def _get_mnemonic(self, doc, base_url):
-        table = next(
-            iter(doc.xpath('(//h2[text()="Mnemonic"]/following-sibling::table[@class="definition"])[1]')), None
-        )
+    def _get_mnemonic(self, sections, base_url):
+        table = sections.get('Mnemonic')
         if table is None:
             return '', ''
-        content = self._nodes_to_string(table.xpath('./tr[1]/td[2]/p/node()'), base_url)
+        content = self._nodes_to_string(KD_XP_MNEMONIC(table), base_url)
         full = self._nodes_to_string([table], base_url)
         return full, content
 
     # tries to extract the kd kanji components, otherwise returns the empty string
-    def _get_components(self, doc, base_url):
-        h1 = next(iter(doc.xpath('//div[@class="span8"]/h1/span[@class="kanji_character"]/..')), None)
-        if h1 is not None:
-            return self._nodes_to_string([h1.tail] + h1.xpath('./following-sibling::*'), base_url)
+    def _get_components(self, sections, base_url):
+        span = sections.get('kanji')
+        if span is not None:
+            h1 = span.getparent()
+            return self._nodes_to_string([h1.tail] + KD_XP_NEXT_ELEMENTS(h1), base_url)
         return ''
 
     # tries to extract the kd kanji jukugo, otherwise returns the empty string
-    def _get_jukugo(self, doc, base_url):
-        table = next(iter(doc.xpath('(//h2[text()="Jukugo"]/following-sibling::table[@class="definition"])[1]')), None)
+    def _get_jukugo(self, sections, base_url):
+        table = sections.get('Jukugo')
         if table is None:
             return '', '', '', ''
         full = self._nodes_to_string([table], base_url)
-        jk = self._nodes_to_string(table.xpath('./tr[1]/td[1]/node()'), base_url)
-        jk_meaning = str(next(iter(table.xpath('./tr[1]/td[2]/p/text()[1]')), '')).strip()
-        jk_use = str(next(iter(table.xpath('./tr[1]/td[2]/p/span[@class="usefulness-stars"]/text()')), '')).strip()
+        jk = self._nodes_to_string(KD_XP_FIRST_WORD(table), base_url)
+        jk_meaning = str(next(iter(KD_XP_JK_MEANING(table)), '')).strip()
+        jk_use = str(next(iter(KD_XP_JK_USEFULNESS(table)), '')).strip()
         return full, jk, jk_meaning, jk_use
 
     # tries to extract the kd kanji full header, otherwise returns the empty string
-    def _get_header(self, doc, base_url):
-        path = '(//div[@class="span8"])[1]'
-        return self._nodes_to_string(doc.xpath(path), base_url)
+    def _get_header(self, sections, base_url):
+        div = sections.get('header')
+        return self._nodes_to_string([div] if div is not None else [], base_url)
 
     # tries to extract the kd kanji lookalikes table, otherwise returns the empty string
-    def _get_lookalikes(self, doc, base_url):
+    def _get_lookalikes(self, sections, base_url):
         nodes = []
-        n = next(iter(doc.xpath('//h2[text()="Lookalikes"]')), None)
+        n = sections.get('Lookalikes')
         if n is not None:
             nodes.append(n.tail)
             n = n.getnext()
@@ -334,33 +621,82 @@ class KanjiDamage:
     #      'furigana': <reading>,
     #      'meaning': <meaning>
     # }
-    def get_kanji_to_words(self):
+    # words extracted by the last update() are reused, the ones of unchanged notes are loaded from the words cache
+    # (see WordsCache, no cache if words_cache is None), the other notes have their tables parsed again,
+    # by 'workers' processes if there are enough of them (see KD_PARALLEL_MIN_NOTES)
+    def get_kanji_to_words(self, workers=1, words_cache=KD_WORDS_CACHE):
         self.log.info('loading words from kanji damage')
         kanji_to_words = {}
+        kanji_to_key = {}
+        pending = []  # (kanji, (kanji field, full kunyomi, full jukugo))
         for kanji, note in self.get_notes(expr=util.KANJI_REGEX).items():
-            words = self._extract_kuyomis(note)
-            seen_words = [k['word'] for k in words]
-            words += [j for j in self._extract_jukugo(note) if j['word'] not in seen_words]
-            kanji_to_words[kanji] = words
+            fields = (note['Kanji'], note['Full kunyomi'], note['Full jukugo'])
+            kanji_to_key[kanji] = words_key(*fields)
+            kanji_to_words[kanji] = self._page_words.get(kanji)
+            if kanji_to_words[kanji] is None:
+                pending.append((kanji, fields))
+
+        cache = WordsCache(words_cache, self.log) if words_cache else None
+        try:
+            if cache is not None:
+                cached = cache.get_many(kanji_to_key[kanji] for kanji, _ in pending)
+                self.log.info('loaded the words of %d notes from cache file %s', len(cached), words_cache)
+                profiling.count('kd_words.cache_hits', len(cached))
+                profiling.count('kd_words.cache_misses', len(pending) - len(cached))
+                for kanji, _ in pending:
+                    kanji_to_words[kanji] = cached.get(kanji_to_key[kanji])
+                pending = [(kanji, fields) for kanji, fields in pending if kanji_to_words[kanji] is None]
+
+            if (workers > 1) and (len(pending) >= KD_PARALLEL_MIN_NOTES):
+                self.log.info('parsing %d notes using %d processes', len(pending), workers)
+                chunk_size = max(1, len(pending) // (workers * KD_PARALLEL_CHUNKS_PER_WORKER))
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    columns = zip(*[fields for _, fields in pending])
+                    results = executor.map(extract_note_words, *columns, chunksize=chunk_size)
+                    for (kanji, _), words in zip(pending, results):
+                        kanji_to_words[kanji] = words
+            else:
+                for kanji, fields in pending:
+                    kanji_to_words[kanji] = extract_note_words(*fields)
+
+            if cache is not None:
+                stored = [kanji for kanji, _ in pending] + [k for k in self._page_words if k in kanji_to_key]
+                cache.put_many({kanji_to_key[kanji]: kanji_to_words[kanji] for kanji in stored})
+        finally:
+            if cache is not None:
+                cache.close()
         return kanji_to_words
 
+    # kunyomi words followed by the jukugo words that aren't kunyomi words
+    @staticmethod
+    def _merge_words(kun_words, jk_words):
+        seen_words = [k['word'] for k in kun_words]
+        return kun_words + [j for j in jk_words if j['word'] not in seen_words]
+
     KD_JK_CLEAN = re.compile(util.NON_JAPANESE_REGEX_STR)
 
-    def _extract_jukugo(self, note):
-        jukugo = note['Full jukugo']
+    # parses a table stored in a note field, None if the field is empty
+    @staticmethod
+    def _parse_table(html):
+        return lxml.html.fromstring(html) if html else None
+
+    # extracts the words from a jukugo table element
+    @staticmethod
+    def _jukugo_words(table):
         words = []
-        if jukugo:
-            table = lxml.html.fromstring(jukugo)
-            for row in table.xpath('//tr'):
+        if table is not None:
+            for row in KD_XP_ROWS(table):
                 entry = dict()
 
-                meaning = row.xpath('td[2]/node()')
+                meaning = KD_XP_ROW_MEANING(row)
                 meaning = [util.html_to_string(e) if type(e) is lxml.html.HtmlElement else str(e) for e in meaning]
-                entry['meaning'] = ''.join([self._jap_ascii(text).strip() for text in meaning])
+                entry['meaning'] = ''.join([text.strip() for text in KanjiDamage._jap_ascii_all(meaning)])
 
-                word = row.xpath('td[1]//ruby[1]/text()')
-                entry['word'] = ''.join([self.KD_JK_CLEAN.sub('', self._jap_ascii(node).lower()) for node in word])
-                entry['furigana'] = next(iter(row.xpath('td[1]//ruby[1]/rt/text()')), '').strip()
+                word = KD_XP_JK_WORD(row)
+                entry['word'] = ''.join(
+                    [KanjiDamage.KD_JK_CLEAN.sub('', node.lower()) for node in KanjiDamage._jap_ascii_all(word)]
+                )
+                entry['furigana'] = next(iter(KD_XP_JK_FURIGANA(row)), '').strip()
                 words.append(entry)
         return words
 
@@ -368,49 +704,78 @@ class KanjiDamage:
     KD_KUN_PREF = re.compile(r'^[(](?P<prefix>[^)]*)[)](?P<root>.*)')
     KD_KUN_SUFF = re.compile(r'(?P<root>[^(]*)[(](?P<suffix>[^)]*)[)]$')
 
-    def _extract_kuyomis(self, note):
-        kun = note['Full kunyomi']
+    # extracts the words from a kunyomi table element
+    @staticmethod
+    def _kunyomi_words(table, kanji):
         words = []
-        if kun:
-            table = lxml.html.fromstring(kun)
-            for row in table.xpath('//tr'):
+        if table is not None:
+            for row in KD_XP_ROWS(table):
                 entry = dict()
 
-                meaning = row.xpath('td[2]/node()')
+                meaning = KD_XP_ROW_MEANING(row)
                 meaning = [util.html_to_string(e) if type(e) is lxml.html.HtmlElement else str(e) for e in meaning]
-                entry['meaning'] = ''.join([self._jap_ascii(text).strip() for text in meaning])
+                entry['meaning'] = ''.join([text.strip() for text in KanjiDamage._jap_ascii_all(meaning)])
 
-                word_it = row.xpath('td[1]//text()')
-                word = ''.join([self.KD_KUN_CLEAN.sub('', self._jap_ascii(node).lower()) for node in word_it])
+                word_it = KD_XP_KUN_WORD(row)
+                word = ''.join(
+                    [KanjiDamage.KD_KUN_CLEAN.sub('', node.lower()) for node in KanjiDamage._jap_ascii_all(word_it)]
+                )
                 parts = word.split('*')
                 if parts:
-                    root, entry['prefix'] = self._kunyomi_get_affix(parts[0], self.KD_KUN_PREF, 'prefix')
+                    root, entry['prefix'] = KanjiDamage._kunyomi_get_affix(parts[0], KanjiDamage.KD_KUN_PREF, 'prefix')
                     parts[0] = root
-                    tail, suffix = self._kunyomi_get_affix(parts[-1], self.KD_KUN_SUFF, 'suffix')
+                    tail, suffix = KanjiDamage._kunyomi_get_affix(parts[-1], KanjiDamage.KD_KUN_SUFF, 'suffix')
                     entry['suffix'] = suffix
                     if (len(parts) == 1) and (not suffix):
                         tail = ''
                     entry['furigana'] = root + tail
-                    entry['word'] = note['Kanji'] + tail
+                    entry['word'] = kanji + tail
                 words.append(entry)
         return words
 
-    def _kunyomi_get_affix(self, word, expr, group_name):
+    @staticmethod
+    def _kunyomi_get_affix(word, expr, group_name):
         m = expr.match(word)
         if m:
             return m.group('root'), m.group(group_name)
         return word, ''
 
+    # japanese full width letters to ascii, converting many texts at once (most texts have none, so they're
+    # checked first), returns a list
     @staticmethod
-    def _jap_ascii(word):
-        chars = []
-        for c in word:
-            # japanese full width letters to ascii
-            n = ord(c)
-            if (n >= ORD_JAP_BASE) and (n <= ORD_JAP_TOP):
-                chars.append(chr(ORD_ASCII_BASE + n - ORD_JAP_BASE))
-            elif n == ORD_JAP_SP:
-                chars.append(' ')
-            else:
-                chars.append(c)
-        return ''.join(chars)
+    def _jap_ascii_all(words):
+        words = [str(w) for w in words]
+        text = KD_JAP_ASCII_SEP.join(words)
+        if not KD_JAP_ASCII_REGEX.search(text):
+            return words
+        return text.translate(KD_JAP_ASCII_TABLE).split(KD_JAP_ASCII_SEP)
+
+
+# extracts the words of one note from its raw 'Kanji', 'Full kunyomi' and 'Full jukugo' fields
+# (a module function, so it can run on the worker processes of KanjiDamage.get_kanji_to_words)
+def extract_note_words(kanji, kunyomi, jukugo):
+    return KanjiDamage._merge_words(
+        KanjiDamage._kunyomi_words(KanjiDamage._parse_table(kunyomi), kanji),
+        KanjiDamage._jukugo_words(KanjiDamage._parse_table(jukugo))
+    )
+
+
+# the version of the words extraction: a hash of the source of the functions extracting the words and of the
+# patterns and xpath expressions they use, so any change to them invalidates the words cache
+@functools.lru_cache(maxsize=None)
+def words_version():
+    functions = [
+        extract_note_words, KanjiDamage._parse_table, KanjiDamage._merge_words, KanjiDamage._kunyomi_words,
+        KanjiDamage._jukugo_words, KanjiDamage._kunyomi_get_affix, KanjiDamage._jap_ascii_all, util.html_to_string
+    ]
+    patterns = [
+        KanjiDamage.KD_KUN_CLEAN, KanjiDamage.KD_KUN_PREF, KanjiDamage.KD_KUN_SUFF, KanjiDamage.KD_JK_CLEAN,
+        KD_JAP_ASCII_REGEX, util.HTML_SRC_REGEX
+    ]
+    xpaths = [KD_XP_ROWS, KD_XP_ROW_MEANING, KD_XP_JK_WORD, KD_XP_JK_FURIGANA, KD_XP_KUN_WORD]
+    sha1 = hashlib.sha1()
+    for text in [inspect.getsource(f) for f in functions] + [p.pattern for p in patterns] + [x.path for x in xpaths]:
+        sha1.update(text.encode('utf-8'))
+        sha1.update(b'\0')
+    sha1.update(json.dumps(KD_JAP_ASCII_TABLE, sort_keys=True).encode('utf-8'))
+    return sha1.hexdigest()
@@ -0,0 +1,350 @@
+import re
+import logging
+import codecs
+import copy
+import bisect
+import heapq
+import json
+import hashlib
+from operator import itemgetter
+import util
+import wordfreq
+import profiling
+from tangorin import Tangorin as tg
+
+
+# builds the 'kanji damage words' deck (see kdw_notes and kdw_create), used by anki-kanji.py
+TG_FILE = 'tangorin.db'
+TG_LEGACY_FILE = 'tangorin.json'
+KDW_DECK = 'KanjiDamage Words'
+KDW_MODEL = 'KanjiDamageWords'
+KDW_FIELDS = ['Kanji', 'Furigana', 'Meaning', 'Examples']
+KDW_TEMPLATES = ['Read', 'Meaning']
+KDW_AFFIX_REGEX = re.compile(r'\(<span class="particles">[^<]*</span>\)')
+WF_INDEX_FILE = 'word-freq.idx'
+
+log = logging.getLogger('anki-kanji.kdw')
+
+
+# loads the word frequency ranking blended from sources [(path, weight)] (see wordfreq.blend_word_freq)
+# the blended scores are compiled into a binary index (WF_INDEX_FILE) the first time and every time a source changes
+def load_word_freq(sources):
+    log.info('loading word frequency files: %s', ', '.join(path for path, _ in sources))
+    try:
+        return wordfreq.load_ranking(sources, WF_INDEX_FILE, log)
+    except (FileNotFoundError, IOError):
+        log.info("couldn't load word frequency files")
+    return wordfreq.FrequencyRanking()
+
+
+# the contents the 'kanji damage words' model should have:
+# css (None if there's no css file), field names and templates as [name, front, back]
+def kdw_model_spec():
+    return {
+        'css': util.load_file('kdw.css', log),
+        'fields': KDW_FIELDS,
+        'templates': [
+            [
+                name,
+                util.load_template_file('kdw', name, 'front', log) or '',
+                util.load_template_file('kdw', name, 'back', log) or ''
+            ]
+            for name in KDW_TEMPLATES
+        ],
+    }
+
+
+# the contents of an existing model, in the same format of kdw_model_spec
+def model_spec_of(model):
+    return {
+        'css': model['css'],
+        'fields': [f['name'] for f in model['flds']],
+        'templates': [[t['name'], t['qfmt'], t['afmt']] for t in model['tmpls']],
+    }
+
+
+def model_spec_hash(spec):
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# removes the previous 'kanji damage words' deck and model if it exists
+# then creates and return a referende to them (deck, model)
+def kdw_reset_model_and_deck(col, spec=None):
+    spec = spec or kdw_model_spec()
+    util.remove_model_and_deck(col, KDW_MODEL, KDW_DECK, log)
+    deck_id = col.decks.id(KDW_DECK)
+    model = col.models.new(KDW_MODEL)
+    model['did'] = deck_id
+    model['css'] = spec['css'] or model['css']
+    col.models.add(model)
+
+    for name in spec['fields']:
+        col.models.addField(model, col.models.newField(name))
+
+    for name, front, back in spec['templates']:
+        tmpl = col.models.newTemplate(name)
+        tmpl['qfmt'] = front
+        tmpl['afmt'] = back
+        tmpl['bqfmt'] = tmpl['qfmt']
+        tmpl['bafmt'] = tmpl['afmt']
+        col.models.addTemplate(model, tmpl)
+    col.save()
+
+    return model, col.decks.get(deck_id)
+
+
+# returns the existing 'kanji damage words' (model, deck), creating them if needed
+# the model is left alone unless its contents changed: then the css and templates are updated in place,
+# or the model and deck are recreated if the fields or the template names changed
+def kdw_sync_model_and_deck(col):
+    spec = kdw_model_spec()
+    model = col.models.byName(KDW_MODEL)
+    if not model:
+        return kdw_reset_model_and_deck(col, spec)
+
+    current = model_spec_of(model)
+    spec['css'] = spec['css'] or current['css']
+    if model_spec_hash(current) != model_spec_hash(spec):
+        if (current['fields'] != spec['fields']) or \
+                ([t[0] for t in current['templates']] != [t[0] for t in spec['templates']]):
+            log.info("'%s' fields changed, recreating it", KDW_MODEL)
+            return kdw_reset_model_and_deck(col, spec)
+        model['css'] = spec['css']
+        for tmpl, (_, front, back) in zip(model['tmpls'], spec['templates']):
+            tmpl['qfmt'] = front
+            tmpl['afmt'] = back
+            tmpl['bqfmt'] = tmpl['qfmt']
+            tmpl['bafmt'] = tmpl['afmt']
+        col.models.save(model)
+        log.info("updated '%s' templates", KDW_MODEL)
+
+    deck_id = col.decks.id(KDW_DECK)
+    return model, col.decks.get(deck_id)
+
+
+# applies the notes {word : {field name : value}} to the 'kanji damage words' model:
+# adds the new words, updates the notes whose fields changed and removes the words that aren't there anymore,
+# keeping the ids (and review history) of all other notes
+def kdw_sync_notes(col, model, deck, notes):
+    names = col.models.fieldNames(model)
+    kanji_idx = names.index('Kanji')
+    existing = {}  # {word : (note id, [field values])}
+    removed = []
+    for nid, values in util.get_note_fields(col, model):
+        word = KDW_AFFIX_REGEX.sub('', values[kanji_idx])
+        if (word in existing) or (word not in notes):
+            removed.append(nid)
+        else:
+            existing[word] = (nid, values)
+
+    added = [fields for word, fields in notes.items() if word not in existing]
+    changed = [
+        (nid, notes[word]) for word, (nid, values) in existing.items()
+        if [notes[word].get(name, '') for name in names] != values
+    ]
+    util.add_notes_bulk(col, model, deck['id'], added)
+    util.update_notes_bulk(col, model, changed)
+    if removed:
+        col.remNotes(removed)
+    profiling.count('kdw.notes_added', len(added))
+    profiling.count('kdw.notes_updated', len(changed))
+    profiling.count('kdw.notes_removed', len(removed))
+    profiling.count('kdw.notes_unchanged', len(existing) - len(changed))
+    log.info(
+        '%d notes were created, %d updated, %d removed and %d unchanged',
+        len(added), len(changed), len(removed), len(existing) - len(changed)
+    )
+
+
+# mergest the word databases created from kd and tangorin, ranking the tangorin words with word_freq
+# (a wordfreq.FrequencyRanking)
+# the result will be a list of tuples (kanji, [word entries])
+# each word entry will be {
+#      'word': <in kanji>,
+#      'prefix': <prefix like wo or ga or empty>,
+#      'suffix': <suffix, like 'xxxx', de, ni or empty>,
+#      'furigana': <reading>,
+#      'meaning': <meaning>,
+#      'sort': <precedence of this word for this kanji, float, always present>,
+#      'sort2': <second level of precedence of this word for this kanji (sort is the same), float, may be absent>,
+# }
+def kdw_merge_kd_tg(kanjis_ordered, kd_kanji_to_words, tg_kanji_to_words, word_freq):
+    result = []
+
+    # scores all tangorin words at once: {(word, reading) : frequency in [0,1]}
+    word_scores = word_freq.scores(
+        (tg_entry['word'], tg_entry.get('furigana'))
+        for kanji in kanjis_ordered
+        for tg_entries in tg_kanji_to_words[kanji].values()
+        for tg_entry in tg_entries
+    )
+
+    # makes a deep copy of a word entry from either database
+    def copy_entry(e):
+        new_e = copy.deepcopy(e)
+        new_e['prefix'] = e.get('prefix', '')
+        new_e['suffix'] = e.get('suffix', '')
+        return new_e
+
+    # index of a kanji's entries: {word : [(position in entries, honorific)]}, sorted by position
+    # kanji damage entries with the 'お' prefix are also indexed by their honorific form ('お' + word)
+    class EntryIndex:
+        def __init__(self):
+            self.entries = []
+            self.keys = {}
+
+        def _insert(self, key, position, honorific):
+            bisect.insort(self.keys.setdefault(key, []), (position, honorific))
+
+        def add(self, entry):
+            position = len(self.entries)
+            self.entries.append(entry)
+            self._insert(entry['word'], position, False)
+            if entry['prefix'] == 'お':
+                self._insert('お' + entry['word'], position, True)
+
+        # finds the first entry matching a word, if it's the special case of 'お' prefix, updates the entry word
+        def find(self, word):
+            positions = self.keys.get(word)
+            if not positions:
+                return None
+            position, honorific = positions[0]
+            entry = self.entries[position]
+            if honorific:
+                positions.pop(0)
+                self.keys[entry['word']].remove((position, False))
+                entry['prefix'] = ''
+                entry['word'] = word
+                self._insert(word, position, False)
+            return entry
+
+    for kanji in kanjis_ordered:
+        index = EntryIndex()
+
+        # add all kd entries using negative numbers for the sorting order
+        kd_entries = kd_kanji_to_words[kanji]
+        sort1 = -len(kd_entries)
+        while sort1 < 0:
+            entry = copy_entry(kd_entries[sort1])
+            entry['sort'] = sort1
+            index.add(entry)
+            sort1 += 1
+
+        # now adds tangorin words
+        for reading, tg_entries in tg_kanji_to_words[kanji].items():
+            sort2 = 2
+            for tg_entry in tg_entries:
+                entry = index.find(tg_entry['word'])
+                if entry:  # repeated?
+                    if 'sort2' not in entry:
+                        entry['meaning'] = '<p>' + tg_entry['meaning'] + '</p>' + entry['meaning']
+                        entry['sort2'] = sort2
+                else:
+                    entry = copy_entry(tg_entry)
+                    entry['sort'] = sort1
+                    score = word_scores.get((tg_entry['word'], tg_entry.get('furigana')))
+                    entry['sort2'] = (1 - score) if score is not None else sort2
+                    index.add(entry)
+                sort2 += 1
+            sort1 += 1
+        result.append((kanji, index.entries))
+
+    return result
+
+
+# selects the words of each kanji: all the required ones (negative 'sort') ordered by 'sort', then, for each
+# reading group (same non negative 'sort', in ascending order), up to take_n words with the smallest 'sort2'
+def kdw_select_words(kanji_words, take_n):
+    final_entries = []
+    for (kanji, words) in kanji_words:
+        main_words = []
+        word_groups = {}
+        for word in words:
+            if word['sort'] < 0:
+                main_words.append(word)
+            else:
+                word_groups.setdefault(word['sort'], []).append(word)
+        # all required words have negative 'sort' values
+        main_words.sort(key=itemgetter('sort'))
+        final_entries += main_words
+        # now takes the ones with higher precedence from the other words
+        for key in sorted(word_groups):
+            final_entries += heapq.nsmallest(take_n, word_groups[key], key=itemgetter('sort2'))
+    return final_entries
+
+
+# loads the tangorin words of kanjis (see Tangorin.get_kanji_to_words), fetching the ones that aren't cached
+# by 'workers' threads; max_age is in seconds and refresh lists the kanjis that must be fetched again
+def fetch_tangorin(kanjis, workers=1, max_age=None, refresh=()):
+    return tg.get_kanji_to_words(
+        TG_FILE, kanjis, log, workers, legacy_file=TG_LEGACY_FILE, max_age=max_age, refresh=refresh
+    )
+
+
+# builds the notes of the 'kanji damage words' deck from the kanji damage notes (kd) and tangorin words,
+# returns a map {word : {field name : value}}
+# take_n is the number of extra words taken for each kanji reading
+# freq_sources are the word frequency files [(path, weight)] used to rank the words
+# parse_workers is the number of processes used to extract the words from the kanji damage notes
+# tangorin has the keyword arguments of fetch_tangorin
+def kdw_notes(kd, take_n, freq_sources, parse_workers=1, tangorin=None):
+    # word frequency handling
+    with profiling.span('word_freq'):
+        word_freq = load_word_freq(freq_sources)  # ranks words by frequency in [0,1]
+    with profiling.span('kd_words'):
+        kd_kanji_to_words = kd.get_kanji_to_words(parse_workers)
+        kanjis_ordered = kd.get_kanjis_ordered()  # [kanji characters, ordered by due date]
+    # {kanji : {reading : [words sorted by appearance]}}
+    with profiling.span('tangorin'):
+        tg_kanji_to_words = fetch_tangorin(kanjis_ordered, **(tangorin or {}))
+    with profiling.span('merge'):
+        kanji_words = kdw_merge_kd_tg(kanjis_ordered, kd_kanji_to_words, tg_kanji_to_words, word_freq)
+
+    with profiling.span('select'):
+        final_entries = kdw_select_words(kanji_words, take_n)
+
+    with codecs.open('entries.json', 'wb', encoding='utf-8') as f:
+        json.dump(final_entries, f, ensure_ascii=False, indent=4, sort_keys=True)
+
+    return kdw_entries_to_notes(final_entries)
+
+
+# the notes {word : {field name : value}} of the selected word entries (see kdw_select_words), the first entry
+# of each word wins
+def kdw_entries_to_notes(final_entries):
+    def create_affix_tag(affix):
+        return '(<span class="particles">' + affix + '</span>)' if affix else ''
+
+    log.info('%d word candidates will be processed', len(final_entries))
+    notes = {}
+    for entry in final_entries:
+        if entry['word'] in notes:
+            continue
+        prefix = create_affix_tag(entry['prefix'])
+        suffix = create_affix_tag(entry['suffix'])
+        notes[entry['word']] = {
+            'Kanji': prefix + entry['word'] + suffix,
+            'Furigana': prefix + entry['furigana'] + suffix,
+            'Meaning': entry['meaning'],
+            'Examples': '',
+        }
+    return notes
+
+
+# creates or updates the 'kanji damage words' deck in the collection col (see kdw_notes for the other arguments)
+# if recreate is set, removes the previous deck and model and creates them from scratch
+def kdw_create(col, kd, recreate, take_n, freq_sources, parse_workers=1, tangorin=None):
+    notes = kdw_notes(kd, take_n, freq_sources, parse_workers, tangorin)
+    with profiling.span('notes'):
+        if recreate:
+            log.info("creating '%s' deck", KDW_DECK)
+            kdw_model, kdw_deck = kdw_reset_model_and_deck(col)
+            col.conf['nextPos'] = 1
+        else:
+            log.info("updating '%s' deck", KDW_DECK)
+            kdw_model, kdw_deck = kdw_sync_model_and_deck(col)
+        col.models.setCurrent(kdw_model)
+        col.decks.select(kdw_deck['id'])
+        kdw_sync_notes(col, kdw_model, kdw_deck, notes)
+        col.save()
+        return kdw_model, kdw_deck
@@ -0,0 +1,304 @@
+import os
+import os.path
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import util
+import profiling
+
+
+MEDIA_MANIFEST_FILE = 'kd_media.db'  # the manifest of the kanji damage images, in the working directory
+MEDIA_WORKERS = 8
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_PART_SUFFIX = '.part'  # suffix of the temporary files of the downloads in progress
+
+
+# one file of the manifest: size and sha1 of the downloaded content and name, the file's name in the collection
+# (None until it's added to it)
+MediaEntry = namedtuple('MediaEntry', ['url', 'path', 'etag', 'modified', 'size', 'sha1', 'name'])
+
+
+# the media manifest, a sqlite database with one entry (see MediaEntry) for every downloaded url
+class MediaManifest:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'create table if not exists files (url text primary key, path text not null, etag text, modified text, '
+            'size integer not null, sha1 text not null, name text)'
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def get(self, url):
+        with self._lock:
+            row = self._db.execute(
+                'select url, path, etag, modified, size, sha1, name from files where url = ?', (url,)
+            ).fetchone()
+        return MediaEntry(*row) if row else None
+
+    def all(self):
+        with self._lock:
+            rows = self._db.execute('select url, path, etag, modified, size, sha1, name from files').fetchall()
+        return [MediaEntry(*row) for row in rows]
+
+    # records a download, keeping the name the file has in the collection
+    def put(self, url, path, etag, modified, size, sha1):
+        with self._lock:
+            self._db.execute(
+                'insert into files (url, path, etag, modified, size, sha1) values (?, ?, ?, ?, ?, ?) '
+                'on conflict(url) do update set path = excluded.path, etag = excluded.etag, '
+                'modified = excluded.modified, size = excluded.size, sha1 = excluded.sha1',
+                (url, path, etag, modified, size, sha1)
+            )
+            self._db.commit()
+
+    # records the name the file at path got in the collection
+    def set_name(self, path, name):
+        with self._lock:
+            self._db.execute('update files set name = ? where path = ?', (name, path))
+            self._db.commit()
+
+    def remove(self, urls):
+        with self._lock:
+            self._db.executemany('delete from files where url = ?', ((url,) for url in urls))
+            self._db.commit()
+
+
+# (size, sha1 hex digest) of a file
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MEDIA_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+            size += len(chunk)
+    return size, sha1.hexdigest()
+
+
+# tells if the file at path has the contents recorded by entry (a MediaEntry, may be None)
+# only the size is compared unless full is set, then the contents are hashed too
+def is_intact(entry, path, full=False):
+    if entry is None:
+        return False
+    try:
+        if os.path.getsize(path) != entry.size:
+            return False
+    except OSError:
+        return False
+    return (not full) or (file_digest(path)[1] == entry.sha1)
+
+
+# the name of an entry's file in the collection, files added before the names were recorded kept their own name
+def collection_name(entry):
+    return entry.name or os.path.basename(entry.path)
+
+
+# downloads media files in background threads, each url at most once per run
+# every download is recorded in the media manifest (see MediaManifest), with its etag and last-modified headers,
+# so files already on disk are only downloaded again if they changed on the server or they aren't intact anymore
+# (see is_intact: their sizes are compared, with verify their contents are hashed too)
+class MediaDownloader:
+    def __init__(self, cache_file, log, workers=MEDIA_WORKERS, verify=False):
+        self.log = log
+        self.verify = verify
+        self.manifest = MediaManifest(cache_file)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._downloads = {}  # {url : future}
+        self._registered = {}  # {local path : name in the collection}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # waits for the pending downloads and closes the manifest
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.manifest.close()
+
+    # schedules the download of url into local_path (only once per url)
+    # returns a future whose result tells if the file is available
+    def fetch(self, url, local_path):
+        with self._lock:
+            future = self._downloads.get(url)
+            if future is None:
+                future = self._executor.submit(self._download, url, local_path)
+                self._downloads[url] = future
+            return future
+
+    # adds a downloaded file to the collection (only once per file), returns its name in the collection
+    # must run on the collection's thread
+    def register(self, col, local_path):
+        name = self._registered.get(local_path)
+        if name is None:
+            name = col.media.addFile(local_path)
+            self._registered[local_path] = name
+            self.manifest.set_name(local_path, name)
+        return name
+
+    # checks every file of the manifest and its copy in the collection's media_dir, downloading again the missing
+    # or corrupt files and restoring the copies in the collection from them
+    # returns the number of (checked, repaired, failed) files
+    def verify_all(self, media_dir):
+        entries = self.manifest.all()
+        self.log.info('verifying %d media files%s', len(entries), ' (hashing them)' if self.verify else '')
+        pending = []
+        for entry in entries:
+            if not is_intact(entry, entry.path, self.verify):
+                if not os.path.exists(entry.path):
+                    self.log.info('[missing]: %s', entry.path)
+                else:
+                    self.log.info('[corrupt]: %s', entry.path)
+                pending.append((entry.url, self.fetch(entry.url, entry.path)))
+
+        repaired = 0
+        failed = 0
+        for url, future in pending:
+            available = future.result()
+            entry = self.manifest.get(url)
+            if available and (entry is not None) and is_intact(entry, entry.path):
+                repaired += 1
+            else:
+                failed += 1
+
+        # only the copies whose name was recorded, another file may have had the same name before
+        for entry in self.manifest.all():
+            if entry.name is None:
+                continue
+            col_path = os.path.join(media_dir, entry.name)
+            if is_intact(entry, col_path, self.verify) or not is_intact(entry, entry.path):
+                continue
+            self.log.info('[restore]: %s', col_path)
+            fd, tmp_path = tempfile.mkstemp(dir=media_dir, prefix='.', suffix=MEDIA_PART_SUFFIX)
+            os.close(fd)
+            try:
+                shutil.copyfile(entry.path, tmp_path)
+                os.replace(tmp_path, col_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            repaired += 1
+        profiling.count('media.repaired', repaired)
+        profiling.count('media.failed', failed)
+        return len(entries), repaired, failed
+
+    # a failed download leaves the previous file, which is only used if it's intact
+    def _download(self, url, local_path):
+        try:
+            return self._conditional_download(url, local_path)
+        except Exception:
+            profiling.count('media.failed')
+            self.log.exception('failed to download %s', url)
+            return is_intact(self.manifest.get(url), local_path)
+
+    def _conditional_download(self, url, local_path):
+        headers = {}
+        exists = os.path.exists(local_path)
+        entry = self.manifest.get(url)
+        intact = exists and is_intact(entry, local_path, self.verify)
+        if util.is_offline():
+            if not exists:
+                self.log.error('[missing]: %s', local_path)
+            elif not intact:
+                self.log.warning('[unverified]: %s', local_path)
+            return exists
+        if intact:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.modified:
+                headers['If-Modified-Since'] = entry.modified
+        elif exists and (entry is not None):
+            profiling.count('media.corrupt')
+            self.log.warning('[corrupt]: %s', local_path)
+
+        r = util.http_get(url, stream=True, headers=headers)
+        try:
+            if r.status_code == 304:
+                profiling.count('media.not_modified')
+                self.log.debug('[cached]: %s', local_path)
+                return True
+            if r.status_code != 200:
+                profiling.count('media.failed')
+                self.log.error('failed to download %s, status code: %d', url, r.status_code)
+                return is_intact(entry, local_path)
+
+            # writes into a temporary file, then renames it, so the file is never left truncated
+            sub_dir = os.path.dirname(local_path)
+            os.makedirs(sub_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=sub_dir, prefix='.', suffix=MEDIA_PART_SUFFIX)
+            sha1 = hashlib.sha1()
+            size = 0
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                        f.write(chunk)
+                        sha1.update(chunk)
+                        size += len(chunk)
+                        profiling.count('http.bytes', len(chunk))
+                # the length is only known for the content as sent (not decoded)
+                length = r.headers.get('Content-Length')
+                if length and length.isdigit() and ('Content-Encoding' not in r.headers) and (int(length) != size):
+                    raise IOError('truncated download: {0} of {1} bytes'.format(size, length))
+                os.replace(tmp_path, local_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        finally:
+            r.close()
+        self.manifest.put(
+            url, local_path, r.headers.get('ETag'), r.headers.get('Last-Modified'), size, sha1.hexdigest()
+        )
+        profiling.count('media.downloaded')
+        self.log.debug('[download]: %s', local_path)
+        return True
+
+
+# removes the media downloaded for notes that don't use it anymore:
+# the files of the manifest (cache_file) whose name isn't in referenced (the names used by the notes) are removed
+# with their entries, and so are their copies in the collection's media_dir when no note at all uses them (in_use);
+# the files of the download folders that aren't in the manifest (leftovers of interrupted or older runs) are removed
+# too unless they're referenced; with dry_run nothing is removed
+# returns the paths of the removed files
+def collect_garbage(cache_file, media_dir, referenced, in_use, log, dry_run=False):
+    manifest = MediaManifest(cache_file)
+    try:
+        entries = manifest.all()
+        removed = []
+        unused = [entry for entry in entries if collection_name(entry) not in referenced]
+        for entry in unused:
+            removed.append(entry.path)
+            name = collection_name(entry)
+            if name not in in_use:
+                removed.append(os.path.join(media_dir, name))
+
+        # only the sub folders of the media folder are downloads, the collection's own files are on its root
+        known = {os.path.normcase(os.path.abspath(entry.path)) for entry in entries}
+        media_root = os.path.abspath(media_dir)
+        folders = {os.path.dirname(os.path.abspath(entry.path)) for entry in entries}
+        for folder in sorted(f for f in folders if f.startswith(media_root + os.sep)):
+            for fn in sorted(os.listdir(folder)):
+                path = os.path.join(folder, fn)
+                if os.path.isfile(path) and (os.path.normcase(path) not in known) and \
+                        (fn.endswith(MEDIA_PART_SUFFIX) or (fn not in referenced)):
+                    removed.append(path)
+
+        removed = [path for path in dict.fromkeys(removed) if os.path.isfile(path)]
+        for path in removed:
+            log.info('[%s]: %s', 'unused' if dry_run else 'remove', path)
+            if not dry_run:
+                os.remove(path)
+        if not dry_run:
+            manifest.remove(entry.url for entry in unused)
+            profiling.count('media.removed', len(removed))
+        return removed
+    finally:
+        manifest.close()
@@ -0,0 +1,92 @@
+import os
+import os.path
+import time
+import json
+import codecs
+import cProfile
+import threading
+from contextlib import contextmanager
+
+
+# lightweight instrumentation of the pipeline: timed spans (stages) and counters of events
+# spans may be nested, a nested span is named '<outer span>/<name>'
+# when a profile directory is configured, every outermost span also runs under cProfile and its stats are dumped
+# into '<profile directory>/<span name>.prof'
+_lock = threading.Lock()
+_local = threading.local()  # per thread stack of open span names
+_started = time.time()
+_counters = {}  # {name : value}
+_spans = {}  # {name : [calls, seconds]}, in the order they were first opened
+_profiles = []  # paths of the dumped cProfile stats
+_profile_dir = None
+_profiling = False  # only one cProfile profiler may be active at once
+
+
+# sets the directory that receives a cProfile dump per stage, None to not profile
+def configure(profile_dir=None):
+    global _profile_dir
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    _profile_dir = profile_dir
+
+
+# adds n to the counter name
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+# times the block as the span name, see the module comment
+@contextmanager
+def span(name):
+    global _profiling
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    full_name = '/'.join(stack + [name])
+    profiler = None
+    with _lock:
+        _spans.setdefault(full_name, [0, 0.0])
+        if _profile_dir and not stack and not _profiling:
+            _profiling = True
+            profiler = cProfile.Profile()
+    stack.append(name)
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        seconds = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            _spans[full_name][0] += 1
+            _spans[full_name][1] += seconds
+            calls = _spans[full_name][0]
+        if profiler is not None:
+            # repeated spans are dumped into '<name>.<call number>.prof'
+            suffix = '.{0}.prof'.format(calls) if calls > 1 else '.prof'
+            path = os.path.join(_profile_dir, full_name.replace('/', '.') + suffix)
+            profiler.dump_stats(path)
+            with _lock:
+                _profiles.append(path)
+                _profiling = False
+
+
+# the instrumentation collected so far, as a json serializable map
+def report():
+    with _lock:
+        return {
+            'started': _started,
+            'seconds': time.time() - _started,
+            'spans': [{'name': name, 'calls': calls, 'seconds': seconds} for name, (calls, seconds) in _spans.items()],
+            'counters': dict(sorted(_counters.items())),
+            'profiles': list(_profiles),
+        }
+
+
+def write_report(path):
+    with codecs.open(path, 'wb', encoding='utf-8') as f:
+        json.dump(report(), f, ensure_ascii=False, indent=4)
@@ -1,39 +1,177 @@
+import os.path
+import time
 import codecs
 import json
+import sqlite3
+import lxml.etree
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import util
+import profiling
 
 
 TG_BASE_URL = 'http://tangorin.com'
 TG_KANJI_PATH = '/kanji'
+TG_XP_ROWS = lxml.etree.XPath('//table[@class="k-compounds-table"]//tr')
+TG_XP_READING = lxml.etree.XPath('.//td[1]/span[@class="kana"]/b')
+TG_XP_WORD_CELLS = lxml.etree.XPath('.//td[2]')
+TG_SQL_CHUNK = 500  # max number of sqlite parameters per query
+TG_STATUS_OK = 'ok'
+TG_STATUS_ERROR = 'error'
+TG_RETRY_BASE = 60  # seconds to wait before retrying a failed kanji, doubled after each failure
+TG_RETRY_MAX = 24 * 60 * 60
+
+
+# one cached kanji: words is None if the last fetch failed, fetched is a unix timestamp
+TangorinEntry = namedtuple('TangorinEntry', ['words', 'status', 'fetched', 'failures'])
+
+
+# persistent per kanji cache of tangorin words, stored in a sqlite database
+# every entry is committed as soon as it's stored, so an interrupted run resumes where it stopped
+class TangorinCache:
+    def __init__(self, path, log):
+        self.path = path
+        self.log = log
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute(
+            'create table if not exists words (kanji text primary key, data text not null, status text not null, '
+            'fetched real not null, failures integer not null)'
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('select count(*) from words').fetchone()[0]
+
+    # loads only the requested kanjis, returns a map {kanji : TangorinEntry}
+    def get_many(self, kanjis):
+        kanjis = list(kanjis)
+        result = {}
+        for i in range(0, len(kanjis), TG_SQL_CHUNK):
+            chunk = kanjis[i:i + TG_SQL_CHUNK]
+            rows = self.conn.execute(
+                'select kanji, data, status, fetched, failures from words where kanji in ({0})'.format(
+                    ','.join('?' * len(chunk))
+                ),
+                chunk
+            )
+            for kanji, data, status, fetched, failures in rows:
+                result[kanji] = TangorinEntry(json.loads(data), status, fetched, failures)
+        return result
+
+    # stores (and commits) the words of one kanji, words being None means the fetch failed
+    # a failed fetch only updates the status of a kanji, the words it had are kept
+    def put(self, kanji, words, fetched=None):
+        status = TG_STATUS_OK if words is not None else TG_STATUS_ERROR
+        self.conn.execute(
+            'insert into words (kanji, data, status, fetched, failures) values (?, ?, ?, ?, ?) '
+            'on conflict(kanji) do update set '
+            'data = case when excluded.failures = 0 then excluded.data else data end, status = excluded.status, '
+            'fetched = excluded.fetched, failures = case when excluded.failures = 0 then 0 else failures + 1 end',
+            (kanji, json.dumps(words, ensure_ascii=False), status, fetched or time.time(),
+             0 if words is not None else 1)
+        )
+        self.conn.commit()
+
+    # imports a cache file in the old format (one json map for all kanjis), returns the number of entries
+    # the file modification time is used as the fetch time of the imported entries
+    def import_json(self, json_file):
+        try:
+            with codecs.open(json_file, 'rb', 'utf-8') as f:
+                kanji_to_words = json.load(f)
+            fetched = os.path.getmtime(json_file)
+        except (FileNotFoundError, IOError, ValueError):
+            return 0
+        with self.conn:
+            self.conn.executemany(
+                'insert or ignore into words (kanji, data, status, fetched, failures) values (?, ?, ?, ?, ?)',
+                (
+                    (k, json.dumps(v, ensure_ascii=False), TG_STATUS_OK if v is not None else TG_STATUS_ERROR,
+                     fetched, 0 if v is not None else 1)
+                    for k, v in kanji_to_words.items()
+                )
+            )
+        self.log.info('imported %d entries from %s', len(kanji_to_words), json_file)
+        return len(kanji_to_words)
+
+
+# tells if a cached entry must be fetched again:
+# failed entries are retried after an exponential backoff, good ones once they're older than max_age seconds
+def is_stale(entry, now, max_age=None):
+    age = now - entry.fetched
+    if entry.status != TG_STATUS_OK:
+        return age >= min(TG_RETRY_BASE * 2 ** max(entry.failures - 1, 0), TG_RETRY_MAX)
+    return (max_age is not None) and (age > max_age)
 
 
 class Tangorin:
     # for each kanji on the list, loads word examples from tangorin website
     # and returns a map {kanji : {reading : [words sorted by appearance]}}
+    # kanjis missing from the cache, stale (see is_stale) or listed in 'refresh' are fetched by up to 'workers'
+    # threads sharing util's http session and stored in the cache as soon as each one arrives
+    # kanjis that couldn't be fetched map to an empty dict
+    # if the cache is new and legacy_file (the old json cache) exists, it's imported first
     @staticmethod
-    def get_kanji_to_words(cache_file, kanjis, log):
+    def get_kanji_to_words(cache_file, kanjis, log, workers=1, legacy_file=None, max_age=None, refresh=()):
         log.info('loading tangorin words')
-        kanji_to_words = {}
-        try:
-            with codecs.open(cache_file, 'rb', 'utf-8') as f:
-                kanji_to_words = json.load(f)
-                log.info('loaded from cache file %s', cache_file)
-        except (FileNotFoundError, IOError):
-            pass
+        is_new = not os.path.exists(cache_file)
+        refresh = set(refresh)
+        with TangorinCache(cache_file, log) as cache:
+            if is_new and legacy_file:
+                cache.import_json(legacy_file)
+            entries = cache.get_many(dict.fromkeys(kanjis))
+            log.info('loaded %d entries from cache file %s', len(entries), cache_file)
+            kanji_to_words = {k: e.words for k, e in entries.items()}
+
+            now = time.time()
+            missing = [
+                k for k in dict.fromkeys(kanjis)
+                if (k not in entries) or (k in refresh) or is_stale(entries[k], now, max_age)
+            ]
+            profiling.count('tangorin.cache_hits', len(set(kanjis)) - len(missing))
+            profiling.count('tangorin.cache_misses', len(missing))
+            for kanji, words in Tangorin._fetch_words(missing, log, workers):
+                cache.put(kanji, words)
+                if words is not None:
+                    kanji_to_words[kanji] = words
+                elif kanji_to_words.get(kanji) is not None:
+                    log.warning('failed to fetch kanji %s again, keeping its cached words', kanji)
+                else:
+                    kanji_to_words[kanji] = None
 
         i = 1
+        failed = 0
         for kanji in kanjis:
-            if kanji not in kanji_to_words:
-                kanji_to_words[kanji] = Tangorin._get_words_for_kanji(kanji, log)
             log.debug('[%d/%d] %s: %s', i, len(kanjis), kanji, str(kanji_to_words[kanji]))
+            if kanji_to_words[kanji] is None:
+                failed += 1
             i += 1
-        try:
-            with codecs.open(cache_file, 'wb', 'utf-8') as f:
-                json.dump(kanji_to_words, f, ensure_ascii=False)
-            log.info('saved cache file %s', cache_file)
-        except IOError:
-            pass
-        return kanji_to_words
+        if failed:
+            log.warning('%d kanjis have no tangorin words, they will be retried on a later run', failed)
+        return {kanji: kanji_to_words[kanji] or {} for kanji in kanjis}
+
+    # fetches the words for each kanji, yielding (kanji, words) as soon as each one is done
+    @staticmethod
+    def _fetch_words(kanjis, log, workers):
+        if kanjis:
+            log.info('fetching %d kanjis from tangorin using %d worker(s)', len(kanjis), workers)
+        if workers <= 1 or len(kanjis) <= 1:
+            for kanji in kanjis:
+                yield kanji, Tangorin._get_words_for_kanji(kanji, log)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(Tangorin._get_words_for_kanji, kanji, log): kanji for kanji in kanjis}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
 
     # given one kanji, uses tangorin to find example words
     # and returns a map {kanji : {reading : [words sorted by appearance]}}
@@ -44,7 +182,7 @@ class Tangorin:
             doc = util.get_html(TG_BASE_URL + TG_KANJI_PATH + '/' + kanji, log)
             if doc is not None:
                 kanji_words = {}
-                for tr in doc.xpath('//table[@class="k-compounds-table"]//tr'):
+                for tr in TG_XP_ROWS(doc):
                     reading, reading_words = Tangorin._process_reading_row(tr)
                     if not reading:
                         log.debug('invalid kanji: %s', kanji)
@@ -56,13 +194,29 @@ class Tangorin:
         return None
 
     # processes one row from the tangorin page main table
+    # each word (<a>) takes its furigana and meaning from the first kana and romaji spans that follow it,
+    # found with a single pass over the children of the words cell
     @staticmethod
     def _process_reading_row(tr):
         words = []
-        reading = str(tr.xpath('.//td[1]/span[@class="kana"]/b')[0].text).strip()
-        for a in tr.xpath('.//td[2]/a'):
-            word = ''.join(a.xpath('.//text()')).strip()
-            furigana = a.xpath('(./following-sibling::span[@class="kana"])[1]')[0].text.strip()
-            meaning = a.xpath('(./following-sibling::span[@class="romaji"])[1]')[0].tail.replace(u'】', '').strip()
-            words.append({'word': word, 'furigana': furigana, 'meaning': meaning})
-        return reading, words
+        reading = str(TG_XP_READING(tr)[0].text).strip()
+        for td in TG_XP_WORD_CELLS(tr):
+            no_furigana = []
+            no_meaning = []
+            for e in td.iterchildren('a', 'span'):
+                if e.tag == 'a':
+                    word = {'word': e.text_content().strip()}
+                    words.append(word)
+                    no_furigana.append(word)
+                    no_meaning.append(word)
+                elif e.get('class') == 'kana':
+                    for word in no_furigana:
+                        word['furigana'] = e.text.strip()
+                    no_furigana = []
+                elif e.get('class') == 'romaji':
+                    for word in no_meaning:
+                        word['meaning'] = e.tail.replace(u'】', '').strip()
+                    no_meaning = []
+            if no_furigana or no_meaning:
+                raise ValueError('word without furigana or meaning in reading {0}'.format(reading))
+        return reading, [{'word': w['word'], 'furigana': w['furigana'], 'meaning': w['meaning']} for w in words]
@@ -1,8 +1,19 @@
 import re
 import codecs
-from urllib.parse import urljoin
+import time
+import zlib
+import random
+import string
+import hashlib
+from html.entities import name2codepoint
+import sqlite3
+import threading
+from urllib.parse import urljoin, urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+import lxml.etree
 import lxml.html
+import profiling
 import json
 
 
@@ -12,6 +23,13 @@ KATAKANA_REGEX_STR = '([ァ-ン])'
 HIRAGANA_REGEX_STR = '([ぁ-ん])'
 JAPANESE_REGEX_STR = '([ぁ-んァ-ン一-龯])'
 NON_JAPANESE_REGEX_STR = '([^ぁ-んァ-ン一-龯])'
+XP_LINKS = lxml.etree.XPath('descendant-or-self::a')
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = 30
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 1.0  # seconds before the first retry, doubled on each new one
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+HTTP_RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
 
 
 def load_file(path, log):
@@ -29,36 +47,189 @@ def load_template_file(prefix, tmpl_name, side, log):
     return load_file('_'.join([prefix, tmpl_name, side]).lower() + '.html', log)
 
 
+# limits how many requests per second are started for each host, shared by all threads
+class RateLimiter:
+    def __init__(self, rate=None):
+        self.interval = (1.0 / rate) if rate else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    # blocks until a request to the url's host is allowed
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_http_lock = threading.Lock()
+_http_session = None
+_http_limiter = RateLimiter()
+
+
+def _new_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# (re)creates the shared http session, keeping up to pool_size connections alive per host,
+# and limits the requests to at most 'rate' per second per host (no limit if rate is None)
+def configure_http(pool_size=HTTP_POOL_SIZE, rate=None):
+    global _http_session, _http_limiter
+    with _http_lock:
+        _http_session = _new_session(pool_size)
+        _http_limiter = RateLimiter(rate)
+        return _http_session
+
+
+# returns the shared http session, creating a default one if needed
+def get_session():
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            _http_session = _new_session(HTTP_POOL_SIZE)
+        return _http_session
+
+
+# gets an url through the shared session, respecting the per host rate limit
+# transient errors (connection errors, timeouts and 429/5xx status codes) are retried with exponential backoff
+def http_get(url, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    attempt = 0
+    while True:
+        _http_limiter.wait(url)
+        profiling.count('http.requests')
+        try:
+            r = get_session().get(url, **kwargs)
+            if (r.status_code not in HTTP_RETRY_STATUS) or (attempt >= retries):
+                return r
+            r.close()
+        except HTTP_RETRY_ERRORS:
+            if attempt >= retries:
+                raise
+        profiling.count('http.retries')
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+
+# archive of raw pages: keeps the compressed body of every page loaded by get_html, keyed by the requested url
+class PageArchive:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('pragma journal_mode=wal')
+        self._db.execute(
+            'create table if not exists pages (url text primary key, final_url text not null, '
+            'status integer not null, fetched real not null, body blob not null)'
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('select count(*) from pages').fetchone()[0]
+
+    # returns (final url, status code, body bytes) or None if the url isn't archived
+    def get(self, url):
+        with self._lock:
+            row = self._db.execute('select final_url, status, body from pages where url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], zlib.decompress(row[2])
+
+    def put(self, url, final_url, status, body):
+        data = zlib.compress(body)
+        with self._lock:
+            self._db.execute(
+                'insert or replace into pages (url, final_url, status, fetched, body) values (?, ?, ?, ?, ?)',
+                (url, final_url, status, time.time(), data)
+            )
+            self._db.commit()
+
+    # lists the archived urls
+    def urls(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('select url from pages order by url')]
+
+
+_archive = None
+_offline = False
+
+
+# makes get_html store every page it loads in the archive at 'path'
+# in offline mode, pages are read only from the archive and nothing is downloaded
+def configure_archive(path, offline=False):
+    global _archive, _offline
+    close_archive()
+    _archive = PageArchive(path)
+    _offline = offline
+    return _archive
+
+
+def close_archive():
+    global _archive, _offline
+    if _archive is not None:
+        _archive.close()
+    _archive = None
+    _offline = False
+
+
+def is_offline():
+    return _offline
+
+
 def get_html(url, log):
-    r = requests.get(url)
-    log.debug('%s - %d', r.url, r.status_code)
-    if r.status_code != 200:
-        log.error('failed to reach %s, status code: %d', r.url, r.status_code)
+    if _offline:
+        page = _archive.get(url)
+        if page is None:
+            profiling.count('archive.misses')
+            log.error('page not archived: %s', url)
+            return None
+        profiling.count('archive.hits')
+        final_url, status, body = page
+    else:
+        r = http_get(url)
+        final_url, status, body = r.url, r.status_code, r.content
+        profiling.count('http.bytes', len(body))
+        if (_archive is not None) and (status == 200):
+            _archive.put(url, final_url, status, body)
+    log.debug('%s - %d', final_url, status)
+    if status != 200:
+        log.error('failed to reach %s, status code: %d', final_url, status)
         return None
-    return lxml.html.fromstring(str(r.content, 'utf-8'))
+    return lxml.html.fromstring(str(body, 'utf-8'))
 
 
 def add_base_url(doc, base_url):
-    for a in doc.xpath('descendant-or-self::a'):
+    for a in XP_LINKS(doc):
         a.set('href', urljoin(base_url, a.get('href')))
 
 
+HTML_SRC_REGEX = re.compile('src="[^"]*"')
+
+
+def _decode_src_blanks(match):
+    return match.group(0).replace('%20', ' ')
+
+
+# serializes an element, undoing the %20 escaping lxml applies to blanks in src attributes
 def html_to_string(e):
     html = lxml.html.tostring(e, encoding='unicode')
-    positions = []
-    src_re = re.compile('src="([^"])*"')
-    blank_re = re.compile('%20')
-    for match in src_re.finditer(html):
-        for blank in blank_re.finditer(html, match.start(), match.end()):
-            positions.append(blank.span())
-    components = []
-    first = 0
-    for pos in positions:
-        components.append(html[first:pos[0]])
-        components.append(' ')
-        first = pos[1]
-    components.append(html[first:])
-    return ''.join(components)
+    if '%20' not in html:
+        return html
+    return HTML_SRC_REGEX.sub(_decode_src_blanks, html)
 
 
 def note_to_json(note):
@@ -78,3 +249,151 @@ def remove_model_and_deck(col, model, deck, log):
     if d:
         col.decks.rem(d['id'], True, True)
         log.info('removed deck %s', deck)
+
+
+# importing anki is slow (and the headless build must work without it), so the helpers anki uses to store notes
+# are reproduced below, behaving like their anki.utils counterparts
+FIELD_SEP = '\x1f'  # separates the fields of a note in the database
+BASE91_TABLE = string.ascii_letters + string.digits + '!#$%&()*+,-./:;<=>?@[]^_`{|}~'
+HTML_COMMENT_REGEX = re.compile('(?s)<!--.*?-->')
+HTML_STYLE_REGEX = re.compile('(?si)<style.*?>.*?</style>')
+HTML_SCRIPT_REGEX = re.compile('(?si)<script.*?>.*?</script>')
+HTML_TAG_REGEX = re.compile('(?s)<.*?>')
+HTML_ENTITY_REGEX = re.compile(r'&#?\w+;')
+HTML_MEDIA_REGEX = re.compile('(?i)<img[^>]+src=["\']?([^"\'>]+)["\']?[^>]*>')
+
+
+# splits the fields of a note as stored in the database, like anki.utils.splitFields
+def split_fields(flds):
+    return flds.split(FIELD_SEP)
+
+
+# joins the fields of a note as stored in the database, like anki.utils.joinFields
+def join_fields(values):
+    return FIELD_SEP.join(values)
+
+
+# the time in integer seconds (scale=1000 for milliseconds), like anki.utils.intTime
+def int_time(scale=1):
+    return int(time.time() * scale)
+
+
+# a number in base 91 (printable characters minus quotes, backslash and separators), like anki.utils.base91
+def base91(num):
+    digits = []
+    while num:
+        num, i = divmod(num, len(BASE91_TABLE))
+        digits.append(BASE91_TABLE[i])
+    return ''.join(reversed(digits))
+
+
+# a random note guid, like anki.utils.guid64
+def guid64():
+    return base91(random.randint(0, 2 ** 64 - 1))
+
+
+def _decode_entity(match):
+    text = match.group(0)
+    try:
+        if text.startswith('&#x'):
+            return chr(int(text[3:-1], 16))
+        if text.startswith('&#'):
+            return chr(int(text[2:-1]))
+        return chr(name2codepoint[text[1:-1]])
+    except (ValueError, KeyError):
+        return text
+
+
+# the text of an html fragment, keeping the names of its images, like anki.utils.stripHTMLMedia
+def strip_html_media(html):
+    html = HTML_MEDIA_REGEX.sub(' \\1 ', html)
+    for regex in (HTML_COMMENT_REGEX, HTML_STYLE_REGEX, HTML_SCRIPT_REGEX, HTML_TAG_REGEX):
+        html = regex.sub('', html)
+    # name2codepoint maps nbsp to \xa0, anki turns it into a plain blank
+    return HTML_ENTITY_REGEX.sub(_decode_entity, html.replace('&nbsp;', ' '))
+
+
+# the checksum anki uses to find duplicates, the first 32 bits of the sha1 of the field's text
+# like anki.utils.fieldChecksum
+def field_checksum(value):
+    return int(hashlib.sha1(strip_html_media(value).encode('utf-8')).hexdigest()[:8], 16)
+
+
+# adds many notes of a standard (non cloze) model to a deck with one bulk insert for the notes and one for the cards,
+# instead of one col.addNote per note; each note gets a new card for every template of the model
+# fields_list is a list of maps {field name : value}, returns the ids of the new notes
+def add_notes_bulk(col, model, deck_id, fields_list):
+    notes, cards, due = note_and_card_rows(
+        model, deck_id, col.models.fieldNames(model), col.models.sortIdx(model), fields_list,
+        nid=max(int_time(1000), (col.db.scalar('select max(id) from notes') or 0) + 1),
+        cid=max(int_time(1000), (col.db.scalar('select max(id) from cards') or 0) + 1),
+        due=col.conf['nextPos'], usn=col.usn()
+    )
+    col.db.executemany('insert into notes values (?,?,?,?,?,?,?,?,?,?,?)', notes)
+    col.db.executemany('insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', cards)
+    col.conf['nextPos'] = due
+    col.setMod()
+    return [n[0] for n in notes]
+
+
+# the rows of the notes and cards tables for new notes (see add_notes_bulk), names are the model's field names
+# and sort_idx its sort field; nid, cid and due are the first note id, card id and new card position
+# guid_of(fields) gives the guid of a note, random by default
+# returns (note rows, card rows, next new card position)
+def note_and_card_rows(model, deck_id, names, sort_idx, fields_list, nid, cid, due, usn, guid_of=None):
+    now = int_time()
+    notes = []
+    cards = []
+    for fields in fields_list:
+        values = [fields.get(name, '') for name in names]
+        notes.append((
+            nid, guid_of(fields) if guid_of else guid64(), model['id'], now, usn, '', join_fields(values),
+            strip_html_media(values[sort_idx]), field_checksum(values[0]), 0, ''
+        ))
+        for tmpl in model['tmpls']:
+            # new cards: type, queue, due (position), ivl, factor, reps, lapses, left, odue, odid, flags, data
+            cards.append((
+                cid, nid, tmpl.get('did') or deck_id, tmpl['ord'], now, usn,
+                0, 0, due, 0, 0, 0, 0, 0, 0, 0, 0, ''
+            ))
+            cid += 1
+        nid += 1
+        due += 1
+    return notes, cards, due
+
+
+# updates the fields of many notes of a model with a single bulk update
+# updates is a list of (note id, {field name : value}), missing fields are left empty
+def update_notes_bulk(col, model, updates):
+    names = col.models.fieldNames(model)
+    sort_idx = col.models.sortIdx(model)
+    now = int_time()
+    usn = col.usn()
+    rows = []
+    for nid, fields in updates:
+        values = [fields.get(name, '') for name in names]
+        rows.append((
+            now, usn, join_fields(values), strip_html_media(values[sort_idx]), field_checksum(values[0]), nid
+        ))
+    col.db.executemany('update notes set mod=?, usn=?, flds=?, sfld=?, csum=? where id=?', rows)
+    if rows:
+        col.setMod()
+
+
+# loads the fields of all notes of a model with a single query, returns a list of (note id, [field values])
+# with the values in the model's field order
+def get_note_fields(col, model):
+    rows = col.db.all('select id, flds from notes where mid = ?', model['id'])
+    return [(nid, split_fields(flds)) for nid, flds in rows]
+
+
+# the names of the media files used by the notes of a model (of all models if model is None)
+def get_note_media(col, model=None):
+    if model is None:
+        rows = col.db.all('select mid, flds from notes')
+    else:
+        rows = col.db.all('select mid, flds from notes where mid = ?', model['id'])
+    names = set()
+    for mid, flds in rows:
+        names.update(col.media.filesInStr(mid, flds))
+    return names
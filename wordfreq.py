@@ -0,0 +1,252 @@
+import os
+import os.path
+import sys
+import mmap
+import codecs
+import struct
+import hashlib
+import tempfile
+from array import array
+import util
+
+
+# index file layout (native byte order):
+#   header: magic, version, byte order, sha1 of the sources' contents, quick id of the sources (from their stats),
+#   unused (0), number of keys
+#   frequencies: one double per key (a word or word + WF_READING_SEP + reading), normalized in [0,1]
+#   offsets: one unsigned int per key plus one, positions of the keys inside the blob
+#   blob: the utf-8 encoded keys, sorted by their bytes
+WF_MAGIC = b'KDWF'
+WF_VERSION = 1
+WF_HEADER = struct.Struct('=4sIc20sQqI3x')
+WF_BYTE_ORDER = b'l' if sys.byteorder == 'little' else b'b'
+
+
+WF_READING_SEP = '\t'  # separates word and reading in the keys of (word, reading) pairs
+
+
+# streams the entries of a word frequency text file (lines '<rank> <frequency> <word> [<reading>]')
+# yields (word, reading or None, frequency) for each word that contains at least a kanji, skipping repeated ones
+def read_word_freq(path, log):
+    seen = set()
+    with codecs.open(path, 'r', 'utf-8') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            word = fields[2]
+            reading = fields[3] if len(fields) > 3 else None
+            key = (word, reading)
+            if key in seen:
+                log.debug("duplicate word '%s'", word)
+            elif util.KANJI_REGEX.search(word):
+                seen.add(key)
+                yield word, reading, abs(float(fields[1]))
+
+
+# blends several word frequency files: sources is a list of (path, weight)
+# each file is normalized by its own maximum frequency and the score of a key (a word or a (word, reading) pair)
+# is the weighted average of its frequencies, counting 0 for the files where it's missing
+# the files are streamed twice (maximum, then scores), only the blended scores are kept in memory
+def blend_word_freq(sources, log):
+    scores = {}
+    total_weight = sum(weight for _, weight in sources) or 1.0
+    for path, weight in sources:
+        max_freq = max((freq for _, _, freq in read_word_freq(path, log)), default=1.0)
+        share = weight / total_weight
+        words = set()
+        for word, reading, freq in read_word_freq(path, log):
+            if reading is not None:
+                key = word + WF_READING_SEP + reading
+                scores[key] = scores.get(key, 0.0) + freq / max_freq * share
+            if word not in words:  # the surface form takes the first (most frequent) entry of the word
+                words.add(word)
+                scores[word] = scores.get(word, 0.0) + freq / max_freq * share
+    return scores
+
+
+def _file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.digest()
+
+
+# identifies a list of sources, either by their files' stats (quick) or by their contents (full)
+def _sources_digest(sources, full=False):
+    sha1 = hashlib.sha1()
+    for path, weight in sources:
+        stat = os.stat(path)
+        sha1.update(repr((os.path.abspath(path), float(weight))).encode('utf-8'))
+        sha1.update(_file_sha1(path) if full else repr((stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    return sha1.digest()
+
+
+# writes a binary index at index_path with the scores {key : score}
+def write_index(index_path, scores, sha1, quick_id=0):
+    items = sorted((key.encode('utf-8'), score) for key, score in scores.items())
+    freqs = array('d', (score for _, score in items))
+    offsets = array('I', [0])
+    for key, _ in items:
+        offsets.append(offsets[-1] + len(key))
+    header = WF_HEADER.pack(WF_MAGIC, WF_VERSION, WF_BYTE_ORDER, sha1, quick_id, 0, len(items))
+
+    # writes a temporary file and renames it, so a broken index is never left behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(freqs.tobytes())
+            f.write(offsets.tobytes())
+            f.write(b''.join(key for key, _ in items))
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# read only map {key : score} backed by a memory mapped index file (see write_index),
+# words are found by binary search, nothing is parsed when it's opened
+class FrequencyIndex:
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = WF_HEADER.unpack_from(self._mm, 0)
+        self._count = self.header[6]
+        freqs_start = WF_HEADER.size
+        offsets_start = freqs_start + 8 * self._count
+        self._blob_start = offsets_start + 4 * (self._count + 1)
+        view = memoryview(self._mm)
+        self._freqs = view[freqs_start:offsets_start].cast('d')
+        self._offsets = view[offsets_start:self._blob_start].cast('I')
+
+    def close(self):
+        self._freqs.release()
+        self._offsets.release()
+        self._mm.close()
+
+    def __len__(self):
+        return self._count
+
+    def _word(self, i):
+        return self._mm[self._blob_start + self._offsets[i]:self._blob_start + self._offsets[i + 1]]
+
+    def _find(self, word, lo=0):
+        key = word.encode('utf-8')
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if (lo < self._count) and (self._word(lo) == key):
+            return lo
+        return -1 - lo
+
+    # looks up many words at once, returns {word : frequency} for the ones in the index
+    # the words are searched in sorted order, each search starting where the previous one stopped
+    def get_many(self, words):
+        result = {}
+        lo = 0
+        for word in sorted(set(words), key=lambda w: w.encode('utf-8')):
+            i = self._find(word, lo)
+            if i >= 0:
+                result[word] = self._freqs[i]
+                lo = i + 1
+            else:
+                lo = -1 - i
+        return result
+
+    def __contains__(self, word):
+        return self._find(word) >= 0
+
+    def __getitem__(self, word):
+        i = self._find(word)
+        if i < 0:
+            raise KeyError(word)
+        return self._freqs[i]
+
+    def get(self, word, default=None):
+        i = self._find(word)
+        return self._freqs[i] if i >= 0 else default
+
+    def __iter__(self):
+        return (self._word(i).decode('utf-8') for i in range(self._count))
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((self._word(i).decode('utf-8'), self._freqs[i]) for i in range(self._count))
+
+
+def _open_index(index_path):
+    try:
+        return FrequencyIndex(index_path)
+    except (FileNotFoundError, IOError, ValueError, struct.error):
+        return None
+
+
+# ranks words by the blended frequencies of several sources (see blend_word_freq),
+# backed by a precomputed index of the blended scores (no index ranks nothing)
+class FrequencyRanking:
+    def __init__(self, index=None):
+        self.index = index
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+
+    # the score of a word, preferring the score of its (word, reading) pair, or None if it's unknown
+    def score(self, word, reading=None):
+        if self.index is None:
+            return None
+        if reading:
+            score = self.index.get(word + WF_READING_SEP + reading)
+            if score is not None:
+                return score
+        return self.index.get(word)
+
+    # scores many (word, reading) pairs with a single sorted pass over the index,
+    # returns {(word, reading) : score} for the known ones
+    def scores(self, pairs):
+        if self.index is None:
+            return {}
+        pairs = set(pairs)
+        keys = [word for word, _ in pairs] + [word + WF_READING_SEP + reading for word, reading in pairs if reading]
+        found = self.index.get_many(keys)
+        result = {}
+        for word, reading in pairs:
+            score = found.get(word + WF_READING_SEP + reading) if reading else None
+            if score is None:
+                score = found.get(word)
+            if score is not None:
+                result[(word, reading)] = score
+        return result
+
+
+# opens the blended ranking of sources [(path, weight)], stored at index_path
+# the index is rebuilt when the list of sources, their weights or their contents change
+def load_ranking(sources, index_path, log):
+    sources = [(path, weight) for path, weight in sources if os.path.exists(path)]
+    index = _open_index(index_path)
+    if index is not None:
+        magic, version, byte_order, sha1, quick, _, _ = index.header
+        if (magic, version, byte_order) == (WF_MAGIC, WF_VERSION, WF_BYTE_ORDER):
+            if not sources:
+                return FrequencyRanking(index)  # only the index is available
+            if (quick == _quick_id(sources)) or (sha1 == _sources_digest(sources, full=True)):
+                return FrequencyRanking(index)
+        index.close()
+    if not sources:
+        raise FileNotFoundError(index_path)
+    log.info('compiling word frequency files %s into %s', ', '.join(path for path, _ in sources), index_path)
+    write_index(index_path, blend_word_freq(sources, log), _sources_digest(sources, full=True), _quick_id(sources))
+    return FrequencyRanking(FrequencyIndex(index_path))
+
+
+# 64 bits taken from the quick digest of the sources, stored in the index header
+def _quick_id(sources):
+    return struct.unpack('=Q', _sources_digest(sources)[:8])[0]